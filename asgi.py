@@ -0,0 +1,239 @@
+# ASGI entry point. Room streams (/stream/<room>) are served on the event
+# loop, so an idle connected client costs a coroutine rather than a worker
+# thread; every other request is handed to the Flask app in kgoloko_app.py
+# on a thread pool.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+#   gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:app   (with EVENT_BUS = 'unix')
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kgoloko_app import app as flask_app, event_bus, event_hub, open_room_stream, SSE_HEADERS
+from realtime import RoomStream, SSE_KEEPALIVE
+
+# A request holds at most one pooled connection, so with no more threads than
+# DB_POOL_SIZE (set in kgoloko_app.py, whose pool exists by now) no request
+# waits on the pool; more threads would only queue there instead
+flask_app.config.setdefault('ASGI_THREADS', flask_app.config['DB_POOL_SIZE'])
+# Streams are cheap here, so the chat page uses them instead of polling
+flask_app.config['LIVE_STREAM'] = True
+# Streams here cost almost nothing to hold open, so they are recycled rather
+# rarely; a user whose approval or ban status changes has theirs ended at once
+flask_app.config.setdefault('ASGI_STREAM_MAX_SECONDS', 600)
+
+executor = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_THREADS'],
+                              thread_name_prefix='flask')
+
+
+def build_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The body ends where the client's does, even without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+# wsgi.input for a request handed to Flask. Reads from the worker thread pull
+# the next chunk from the client through the event loop, so an upload is
+# never held in memory as a whole and is read only as fast as Flask takes it.
+# A client that disconnects mid-body looks like the body ending early.
+class RequestBody(io.RawIOBase):
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._chunk = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._more = False
+                break
+            self._chunk = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+# Runs the Flask app in a worker thread, streaming the request body in and
+# forwarding the response to the client chunk by chunk, so large files are
+# not buffered in memory either way.
+async def call_flask(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, io.BufferedReader(RequestBody(receive, loop), 64 * 1024))
+
+    def forward(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        def send_start():
+            status, headers = started
+            forward({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+            })
+
+        result = flask_app(environ, start_response)
+        try:
+            sent_start = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not sent_start:
+                    send_start()
+                    sent_start = True
+                forward({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not sent_start:
+                send_start()
+            forward({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    await loop.run_in_executor(executor, run)
+
+
+# Opening a stream touches the database and the Flask session, so it runs on
+# the thread pool; after that the stream lives entirely on the event loop.
+async def serve_stream(scope, receive, send, room):
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, io.BytesIO())
+
+    def subscribe(room, user_id):
+        return event_hub.subscribe_async(room, loop, user_id)
+
+    def open_stream():
+        event_bus.start()
+        with flask_app.request_context(environ):
+            result = open_room_stream(room, subscribe=subscribe)
+            if isinstance(result, RoomStream):
+                return result
+            return flask_app.make_response(result)
+
+    result = await loop.run_in_executor(executor, open_stream)
+    if not isinstance(result, RoomStream):
+        await send({
+            'type': 'http.response.start',
+            'status': result.status_code,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in result.headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': result.get_data()})
+        return
+
+    room_stream = result
+    headers = dict(SSE_HEADERS, **{'Content-Type': 'text/event-stream; charset=utf-8'})
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()],
+    })
+
+    async def body(text):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    async def pump():
+        for text in room_stream.backlog():
+            await body(text)
+        if room_stream.has_more:
+            return
+        keepalive = flask_app.config['STREAM_KEEPALIVE_SECONDS']
+        deadline = time.monotonic() + flask_app.config['ASGI_STREAM_MAX_SECONDS']
+        while not room_stream.sub.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(room_stream.sub.queue.get(), min(keepalive, remaining))
+            except asyncio.TimeoutError:
+                await body(SSE_KEEPALIVE)
+                continue
+            if event is None:
+                break
+            text = room_stream.render(event)
+            if text:
+                await body(text)
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait([pump_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        pump_task.cancel()
+        disconnect_task.cancel()
+        room_stream.close()
+    if pump_task.done() and not pump_task.cancelled() and pump_task.exception() is None:
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            event_bus.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    if scope['method'] == 'GET' and path.startswith('/stream/') and path.count('/') == 2:
+        await serve_stream(scope, receive, send, path[len('/stream/'):])
+    else:
+        await call_flask(scope, receive, send)
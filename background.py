@@ -0,0 +1,30 @@
+import os
+import threading
+
+
+# Start-up of a background service (threads, sockets) that each process needs
+# its own of: run() calls start the first time it is reached in a process,
+# so it runs once at start-up and again in every worker forked after that,
+# where the parent's threads do not exist. Safe to call on every request.
+class PerProcess:
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # True once start has run in this process
+    def started(self):
+        return self._pid == os.getpid()
+
+    def run(self, start):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            start()
+            self._pid = os.getpid()
+
+    # Lets the next run() start the service again (after it was shut down)
+    def reset(self):
+        with self._lock:
+            self._pid = None
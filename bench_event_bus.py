@@ -0,0 +1,101 @@
+# Measures cross-worker delivery latency of the event bus: one publisher and
+# N receiving worker processes on the same host.
+#
+#   python bench_event_bus.py --workers 1 2 4 8 --events 1000
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+import time
+
+from realtime import LocalBus, UnixSocketBus
+
+
+def worker(directory, expected, ready, results):
+    bus = UnixSocketBus(directory)
+    latencies = []
+
+    def on_event(data):
+        latencies.append(time.perf_counter() - data['sent'])
+
+    bus.subscribe('bench', on_event)
+    bus.start()
+    ready.set()
+
+    deadline = time.monotonic() + 30
+    while len(latencies) < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    bus.close()
+    results.put(latencies)
+
+
+def summarize(label, latencies, expected):
+    if not latencies:
+        print(f"{label:>12}: no events delivered")
+        return
+    ms = sorted(l * 1000 for l in latencies)
+    p = lambda q: ms[min(len(ms) - 1, int(len(ms) * q))]
+    print(f"{label:>12}: delivered {len(ms)}/{expected}  "
+          f"p50 {statistics.median(ms):.3f} ms  p95 {p(0.95):.3f} ms  "
+          f"p99 {p(0.99):.3f} ms  max {ms[-1]:.3f} ms")
+
+
+def bench_local(events):
+    bus = LocalBus()
+    latencies = []
+    bus.subscribe('bench', lambda data: latencies.append(time.perf_counter() - data['sent']))
+    for i in range(events):
+        bus.publish('bench', {'seq': i, 'sent': time.perf_counter()})
+    summarize('local', latencies, events)
+
+
+def bench_unix(workers, events, interval):
+    ctx = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as directory:
+        results = ctx.Queue()
+        readies = []
+        procs = []
+        for _ in range(workers):
+            ready = ctx.Event()
+            proc = ctx.Process(target=worker, args=(directory, events, ready, results))
+            proc.start()
+            readies.append(ready)
+            procs.append(proc)
+        for ready in readies:
+            ready.wait()
+
+        publisher = UnixSocketBus(directory)
+        publisher.start()
+        start = time.perf_counter()
+        for i in range(events):
+            publisher.publish('bench', {'seq': i, 'sent': time.perf_counter()})
+            if interval:
+                time.sleep(interval)
+        elapsed = time.perf_counter() - start
+
+        latencies = []
+        for _ in procs:
+            latencies.extend(results.get())
+        for proc in procs:
+            proc.join()
+        publisher.close()
+
+    summarize(f"{workers} workers", latencies, events * workers)
+    print(f"{'':>12}  publish rate {events / elapsed:,.0f} events/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event bus delivery latency benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help="seconds between published events (0 = as fast as possible)")
+    args = parser.parse_args()
+
+    bench_local(args.events)
+    for workers in args.workers:
+        bench_unix(workers, args.events, args.interval)
+
+
+if __name__ == '__main__':
+    main()
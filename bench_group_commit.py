@@ -0,0 +1,95 @@
+# Compares message insert throughput with one commit per message (as
+# send_message does by default) against the group-commit writer, with many
+# threads posting at once.
+#
+#   python bench_group_commit.py --threads 32 --messages 200 --synchronous FULL
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from database import ConnectionPool, GroupCommitWriter
+
+SCHEMA = """
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room TEXT NOT NULL,
+        username TEXT NOT NULL,
+        message TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+INSERT = "INSERT INTO messages (room, username, message) VALUES (?, ?, ?)"
+
+
+def make_pool(path, journal_mode, synchronous, size):
+    def configure(conn):
+        conn.execute("PRAGMA busy_timeout = 30000")
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+    return ConnectionPool(path, size=size, timeout=60, busy_timeout=30, on_connect=configure)
+
+
+def run(label, threads, messages, post):
+    errors = []
+
+    def client(n):
+        try:
+            for i in range(messages):
+                post(('general', f'user{n}', f'message {i} from {n}'))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    total = threads * messages
+    print(f"{label:>14}: {total / elapsed:8,.0f} messages/s  ({total} in {elapsed:.2f} s, {len(errors)} errors)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Group commit throughput benchmark")
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--messages', type=int, default=200, help="messages per thread")
+    parser.add_argument('--journal-mode', default='WAL')
+    parser.add_argument('--synchronous', default='FULL')
+    parser.add_argument('--max-latency-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('per-message', 'group commit'):
+            path = os.path.join(directory, f"{mode.replace(' ', '_')}.db")
+            conn = sqlite3.connect(path)
+            conn.execute(SCHEMA)
+            conn.close()
+            pool = make_pool(path, args.journal_mode, args.synchronous, args.threads + 1)
+
+            if mode == 'per-message':
+                def post(row):
+                    conn = pool.acquire()
+                    try:
+                        conn.execute("BEGIN IMMEDIATE")
+                        conn.execute(INSERT, row)
+                        conn.commit()
+                    finally:
+                        pool.release(conn)
+            else:
+                writer = GroupCommitWriter(pool.connect, max_latency=args.max_latency_ms / 1000)
+
+                def post(row):
+                    writer.submit(lambda c: c.execute(INSERT, row).lastrowid)
+
+            run(mode, args.threads, args.messages, post)
+            if mode == 'group commit':
+                stats = writer.stats()
+                print(f"{'':>14}  {stats['batches']} commits, {stats['avg_batch']:.1f} messages per commit on average")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Compares building a get_messages body with jsonify (a dict per message,
+# encoded on every call) against joining cached per-message JSON fragments,
+# for each available JSON backend.
+#
+#   python bench_serialization.py --sizes 50 850 5000 --repeat 200
+#
+# "fragments (buffer)" reuses the same dicts, as reads served from the recent
+# message buffer do; "fragments (sql)" rebuilds equal dicts each time, as
+# reads that go to the database do; "fragments (cold)" encodes everything.
+import argparse
+import json
+import random
+import time
+
+from flask import Flask, jsonify
+
+from fragments import MessageFragments, json_backends
+
+
+def make_messages(count):
+    messages = []
+    for i in range(1, count + 1):
+        message = {
+            'id': i,
+            'username': f'user{i % 40}',
+            'message': ' '.join(random.choice(['homework', 'due', 'friday', 'maths', 'see', 'you', 'in', 'class'])
+                                for _ in range(random.randint(3, 30))),
+            'message_type': 'text',
+            'file_path': None,
+            'timestamp': f'2024-03-{i % 28 + 1:02d} 10:{i % 60:02d}:00',
+            'is_edited': i % 10 == 0,
+            'edited_at': f'2024-03-{i % 28 + 1:02d} 11:00:00' if i % 10 == 0 else None,
+            'reply_to': i - 1 if i % 5 == 0 else None,
+            'file_name': None,
+            'thumbnail_path': None,
+        }
+        if message['reply_to']:
+            message['reply_username'] = f'user{(i - 1) % 40}'
+            message['reply_preview'] = 'see you in class'
+        messages.append(message)
+    return messages
+
+
+def timed(repeat, fn):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="get_messages serialization benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 850, 5000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    for size in args.sizes:
+        messages = make_messages(size)
+        repeat = max(5, args.repeat * 50 // size)
+        print(f"{size} messages ({repeat} runs)")
+
+        with app.app_context():
+            baseline = timed(repeat, lambda: jsonify([dict(m) for m in messages]).get_data())
+        print(f"  {'dict + jsonify':>28}: {baseline:8.3f} ms")
+
+        for backend in json_backends():
+            fragments = MessageFragments(maxsize=size, backend=backend)
+            assert json.loads(fragments.encode_list(messages)) == messages
+
+            def cold():
+                fragments.clear()
+                return fragments.encode_list(messages)
+
+            for label, fn in (('cold', cold),
+                              ('sql', lambda: fragments.encode_list([dict(m) for m in messages])),
+                              ('buffer', lambda: fragments.encode_list(messages))):
+                fragments.encode_list(messages)
+                ms = timed(repeat, fn)
+                print(f"  {f'fragments ({label}, {backend})':>28}: {ms:8.3f} ms  ({baseline / ms:4.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
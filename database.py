@@ -0,0 +1,308 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from queue import Queue, LifoQueue, Empty
+from flask import g, current_app
+
+from background import PerProcess
+
+logger = logging.getLogger(__name__)
+
+_pool_lock = threading.Lock()
+
+# INSERT/UPDATE ... RETURNING (SQLite 3.35+)
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+# Bounded pool of SQLite connections for one worker process. Each Flask app
+# context checks out at most one connection (see get_db) and hands it back on
+# teardown, so a request never pays for more than one connect.
+class ConnectionPool:
+    def __init__(self, database, size=8, timeout=10.0, slow_checkout=0.05, busy_timeout=5.0, on_connect=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.slow_checkout = slow_checkout
+        self.on_connect = on_connect
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # A configured connection outside the pool, for long-lived users such as
+    # the group-commit writer
+    def connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout, check_same_thread=False)
+        if self.on_connect:
+            self.on_connect(conn)
+        return conn
+
+    def acquire(self):
+        # SQLite connections must not be shared across a fork (gunicorn --preload),
+        # so a worker starts with an empty pool of its own.
+        if self._pid != os.getpid():
+            self._reset()
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Empty:
+                    raise sqlite3.OperationalError(
+                        f"database connection pool exhausted ({self.size} in use for {self.timeout}s)")
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        if waited > self.slow_checkout:
+            logger.warning("Slow database connection checkout: %.1f ms", waited * 1000)
+        return conn
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            conn.close()
+            return
+        try:
+            # Never hand out a connection with a half-finished transaction
+            conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._created,
+                'idle': self._idle.qsize(),
+                'checkouts': self._checkouts,
+                'wait_avg_ms': (self._wait_total / self._checkouts * 1000) if self._checkouts else 0.0,
+                'wait_max_ms': self._wait_max * 1000,
+            }
+
+
+class _WriteRequest:
+    __slots__ = ('fn', 'result', 'error', 'done')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+# Group commit for concurrent writes. Callers hand submit() a function that
+# does their writes on the cursor it is given; a single writer thread runs
+# whatever has queued up within max_latency seconds (up to max_batch) in one
+# transaction, each in its own savepoint so a failing write only undoes
+# itself, and wakes every caller once the shared commit has landed. One
+# commit, and so one fsync, then covers the whole batch.
+class GroupCommitWriter:
+    def __init__(self, connect, max_latency=0.002, max_batch=256):
+        self.connect = connect
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self._queue = Queue()
+        self._process = PerProcess()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._writes = 0
+        self._largest = 0
+
+    def start(self):
+        self._process.run(self._start)
+
+    def _start(self):
+        self._queue = Queue()
+        threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+
+    # Runs fn(cursor) in the next group commit and returns its result once
+    # committed, or raises what fn (or the commit) raised
+    def submit(self, fn):
+        self.start()
+        request = _WriteRequest(fn)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except Empty:
+                    break
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception as e:
+                    logger.exception("Group commit writer could not connect")
+                    for request in batch:
+                        request.error = e
+                        request.done.set()
+                    continue
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for request in batch:
+                c.execute("SAVEPOINT group_write")
+                try:
+                    request.result = request.fn(c)
+                except Exception as e:
+                    c.execute("ROLLBACK TO group_write")
+                    request.error = e
+                c.execute("RELEASE group_write")
+            conn.commit()
+        except Exception as e:
+            logger.exception("Group commit of %d writes failed", len(batch))
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            for request in batch:
+                if request.error is None:
+                    request.result, request.error = None, e
+        finally:
+            with self._lock:
+                self._batches += 1
+                self._writes += len(batch)
+                self._largest = max(self._largest, len(batch))
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_latency_ms': self.max_latency * 1000,
+                'batches': self._batches,
+                'writes': self._writes,
+                'avg_batch': self._writes / self._batches if self._batches else 0.0,
+                'max_batch_seen': self._largest,
+            }
+
+
+def init_pool(app):
+    app.config.setdefault('DATABASE', 'chatdatabase.db')
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10.0)
+    app.config.setdefault('DB_POOL_SLOW_CHECKOUT', 0.05)
+    app.config.setdefault('DB_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('DB_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('DB_CACHE_SIZE_KB', 16 * 1024)
+    app.config.setdefault('DB_MMAP_SIZE', 64 * 1024 * 1024)
+    app.config.setdefault('DB_TEMP_STORE', 'MEMORY')
+    app.config.setdefault('DB_BUSY_TIMEOUT_MS', 5000)
+    app.teardown_appcontext(close_db)
+
+
+# Applied to every new connection before it enters the pool. WAL lets the
+# chat pollers keep reading while send_message holds the write lock, and
+# synchronous=NORMAL is durable across application crashes in WAL mode.
+def configure_connection(conn, config):
+    conn.execute(f"PRAGMA busy_timeout = {int(config['DB_BUSY_TIMEOUT_MS'])}")
+    conn.execute(f"PRAGMA journal_mode = {config['DB_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {config['DB_SYNCHRONOUS']}")
+    # A negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = -{int(config['DB_CACHE_SIZE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(config['DB_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA temp_store = {config['DB_TEMP_STORE']}")
+
+
+SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+TEMP_STORE_NAMES = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+
+# Effective settings as SQLite reports them, for the startup log
+def pragma_report(conn):
+    def pragma(name):
+        return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+    cache_size = pragma('cache_size')
+    return {
+        'journal_mode': pragma('journal_mode'),
+        'synchronous': SYNCHRONOUS_NAMES.get(pragma('synchronous'), 'UNKNOWN'),
+        'cache_size_kb': -cache_size if cache_size < 0 else cache_size * pragma('page_size') // 1024,
+        'mmap_size': pragma('mmap_size'),
+        'temp_store': TEMP_STORE_NAMES.get(pragma('temp_store'), 'UNKNOWN'),
+        'busy_timeout_ms': pragma('busy_timeout'),
+    }
+
+
+def get_pool(app=None):
+    # The real app object, not the proxy: on_connect below may run on threads without an app context
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None:
+                # Built lazily so config set after init_pool() still applies
+                pool = ConnectionPool(app.config['DATABASE'],
+                                      size=app.config['DB_POOL_SIZE'],
+                                      timeout=app.config['DB_POOL_TIMEOUT'],
+                                      slow_checkout=app.config['DB_POOL_SLOW_CHECKOUT'],
+                                      busy_timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                                      on_connect=lambda conn: configure_connection(conn, app.config))
+                app.extensions['db_pool'] = pool
+    return pool
+
+
+# Connection for the current app context; checked out on first use and
+# returned to the pool by close_db when the context is torn down.
+def get_db():
+    if '_db_conn' not in g:
+        g._db_conn = get_pool().acquire()
+    return g._db_conn
+
+
+def close_db(exc=None):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_pool().release(conn)
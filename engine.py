@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 import uuid
 import json
 from functools import wraps
+from database import init_pool, get_db
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
@@ -17,10 +18,12 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 app.secret_key = 'your-secure-secret-key-here'  # Change this to a secure random key
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+app.config['DATABASE'] = 'chatdatabase.db'
+init_pool(app)
 
 # Database setup
 def init_db():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Check if tables exist before creating them
@@ -120,9 +123,9 @@ def init_db():
         c.execute("ALTER TABLE users ADD COLUMN banned_by INTEGER")
     
     conn.commit()
-    conn.close()
 
-init_db()
+with app.app_context():
+    init_db()
 
 # Decorator for login required
 def login_required(f):
@@ -153,11 +156,10 @@ def approval_required(f):
         if 'user_id' not in session:
             return redirect(url_for('login', next=request.url))
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT approved, banned FROM users WHERE id = ?", (session['user_id'],))
         user = c.fetchone()
-        conn.close()
         
         if not user:
             session.clear()
@@ -168,11 +170,10 @@ def approval_required(f):
         
         if user[1]:  # Banned
             # Get ban details
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute("SELECT ban_reason FROM users WHERE id = ?", (session['user_id'],))
             ban_reason = c.fetchone()[0] or "No reason provided"
-            conn.close()
             
             session.clear()
             return f"Your account has been banned. Reason: {ban_reason}", 403
@@ -194,7 +195,7 @@ def login():
         password = request.form['password']
         remember_me = 'remember_me' in request.form
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
         user = c.fetchone()
@@ -202,7 +203,6 @@ def login():
         if user:
             # Check if user is approved (index 5 is the approved column)
             if not user[5]:
-                conn.close()
                 return render_template('login.html', error="Account pending admin approval. Please wait.")
             
             # Check if user is banned (index 6 is the banned column)
@@ -211,7 +211,6 @@ def login():
                 c.execute("SELECT ban_reason FROM users WHERE id = ?", (user[0],))
                 ban_details = c.fetchone()
                 ban_reason = ban_details[0] if ban_details else "No reason provided"
-                conn.close()
                 return render_template('login.html', error=f"Account banned. Reason: {ban_reason}")
             
             session['username'] = user[1]
@@ -232,13 +231,10 @@ def login():
                 c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user[0],))
                 conn.commit()
             
-            conn.close()
-            
             # Redirect to next page if provided, otherwise to chat
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('chat'))
         
-        conn.close()
         return render_template('login.html', error="Invalid credentials")
     
     return render_template('login.html')
@@ -262,7 +258,7 @@ def register():
         if len(password) < 6:
             return render_template('register.html', error="Password must be at least 6 characters")
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         try:
             # New users are not approved by default
@@ -275,12 +271,9 @@ def register():
             c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
             conn.commit()
             
-            conn.close()
-            
             flash('Registration successful! Please wait for admin approval.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
-            conn.close()
             return render_template('register.html', error="Username or email already exists")
     
     return render_template('register.html')
@@ -289,7 +282,7 @@ def register():
 def forgot_password():
     if request.method == 'POST':
         username = request.form['username']
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username = ?", (username,))
         user = c.fetchone()
@@ -298,13 +291,11 @@ def forgot_password():
             reset_token = str(uuid.uuid4())
             c.execute("UPDATE users SET reset_token = ? WHERE username = ?", (reset_token, username))
             conn.commit()
-            conn.close()
             
             # In a real application, you would send an email here
             return render_template('forgot_password.html', 
                                  success=f"Reset token generated: {reset_token}. Use it to update your password.")
         
-        conn.close()
         return render_template('forgot_password.html', error="Username not found")
     
     return render_template('forgot_password.html')
@@ -321,12 +312,11 @@ def update_password():
             if new_password != confirm_password:
                 return render_template('update_password.html', error="Passwords do not match")
             
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute("UPDATE users SET password = ?, reset_token = NULL WHERE username = ?", 
                      (new_password, username))
             conn.commit()
-            conn.close()
             return render_template('update_password.html', success="Password updated successfully")
         else:
             # Password reset via token
@@ -337,7 +327,7 @@ def update_password():
             if new_password != confirm_password:
                 return render_template('update_password.html', error="Passwords do not match")
             
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute("SELECT * FROM users WHERE reset_token = ?", (token,))
             user = c.fetchone()
@@ -346,10 +336,8 @@ def update_password():
                 c.execute("UPDATE users SET password = ?, reset_token = NULL WHERE reset_token = ?", 
                          (new_password, token))
                 conn.commit()
-                conn.close()
                 return render_template('update_password.html', success="Password reset successfully. Please login.")
             
-            conn.close()
             return render_template('update_password.html', error="Invalid or expired reset token")
     
     return render_template('update_password.html')
@@ -358,7 +346,7 @@ def update_password():
 @login_required
 @approval_required
 def chat():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Get all rooms
@@ -381,8 +369,6 @@ def chat():
              (session['user_id'],))
     settings_row = c.fetchone()
     
-    conn.close()
-    
     # Convert settings to a proper dictionary
     settings = {}
     if settings_row:
@@ -404,11 +390,10 @@ def chat():
 @login_required
 @approval_required
 def get_online_users():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT username, role FROM users WHERE is_online = TRUE AND username != ?", (session['username'],))
     online_users = [{'username': row[0], 'role': row[1]} for row in c.fetchall()]
-    conn.close()
     return jsonify(online_users)
 
 @app.route('/send_message', methods=['POST'])
@@ -435,20 +420,18 @@ def send_message():
             return jsonify({'error': 'Text message cannot be empty'}), 400
         
         # Check room access
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT allowed_roles FROM rooms WHERE name = ?", (room,))
         room_data = c.fetchone()
         
         if not room_data:
-            conn.close()
             print("Room not found")
             return jsonify({'error': 'Room not found'}), 404
         
         # Check if user role is allowed (admin can access all rooms)
         allowed_roles = json.loads(room_data[0])
         if session['role'] != 'admin' and session['role'] not in allowed_roles:
-            conn.close()
             print(f"Access denied: User role {session['role']} not allowed in room {room}")
             return jsonify({'error': 'Access denied to this room'}), 403
         
@@ -488,17 +471,14 @@ def send_message():
                         message_content = file_path
                     print(f"File saved: {file_path}")
                 else:
-                    conn.close()
                     print(f"Error: Invalid file extension '{extension}'")
                     return jsonify({'error': f"Invalid file extension. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
             else:
-                conn.close()
                 print("Error: No valid file provided")
                 return jsonify({'error': 'No valid file provided'}), 400
         
         # Ensure there's content to save (either message or file)
         if not message_content and not file_path:
-            conn.close()
             print("Error: No message content or file provided")
             return jsonify({'error': 'Message or file required'}), 400
         
@@ -550,7 +530,6 @@ def send_message():
         """, (message_id,))
         
         message_row = c.fetchone()
-        conn.close()
         
         if not message_row:
             print("Error: Failed to retrieve inserted message")
@@ -577,12 +556,12 @@ def send_message():
     except sqlite3.Error as e:
         print(f"Database error in send_message: {str(e)}")
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
         return jsonify({'error': 'Database error occurred'}), 500
     except Exception as e:
         print(f"Error in send_message: {str(e)}")
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 @app.route('/get_messages/<room>')
@@ -590,7 +569,7 @@ def send_message():
 @approval_required
 def get_messages(room):
     # Check if user has access to this room
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Get room's allowed roles
@@ -598,7 +577,6 @@ def get_messages(room):
     room_data = c.fetchone()
     
     if not room_data:
-        conn.close()
         return jsonify({'error': 'Room not found'}), 404
     
     # Parse allowed roles from JSON string
@@ -606,7 +584,6 @@ def get_messages(room):
     
     # Allow admin to access all rooms
     if session['role'] != 'admin' and session['role'] not in allowed_roles:
-        conn.close()
         return jsonify({'error': 'Access denied to this room'}), 403
     
     # Rest of the function remains the same
@@ -633,7 +610,6 @@ def get_messages(room):
             'edited_at': row[6]
         })
     
-    conn.close()
     return jsonify(messages[::-1])  # Reverse to show oldest first
 
 @app.route('/search_messages')
@@ -646,7 +622,7 @@ def search_messages():
     if not query:
         return jsonify({'error': 'Query parameter required'}), 400
     
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
         SELECT username, message, message_type, timestamp 
@@ -664,7 +640,6 @@ def search_messages():
             'timestamp': row[3]
         })
     
-    conn.close()
     return jsonify(results)
 
 @app.route('/user_settings', methods=['GET', 'POST'])
@@ -678,7 +653,7 @@ def user_settings():
         font_size = request.form.get('font_size')
         auto_login = 'auto_login' in request.form
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("""
             UPDATE user_settings 
@@ -686,17 +661,15 @@ def user_settings():
             WHERE user_id = ?
         """, (theme, notifications, sound_effects, font_size, auto_login, session['user_id']))
         conn.commit()
-        conn.close()
         
         flash('Settings saved successfully!')
         return redirect(url_for('user_settings'))
     
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT theme, notifications, sound_effects, font_size, auto_login FROM user_settings WHERE user_id = ?", 
              (session['user_id'],))
     settings_row = c.fetchone()
-    conn.close()
     
     # Convert settings to a proper dictionary
     settings = {}
@@ -715,11 +688,10 @@ def user_settings():
 def logout():
     if 'username' in session:
         # Update online status
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("UPDATE users SET is_online = FALSE WHERE username = ?", (session['username'],))
         conn.commit()
-        conn.close()
     
     session.clear()
     flash('You have been logged out successfully.')
@@ -750,7 +722,7 @@ def admin_login():
         # Check against simulated admin credentials
         if username in ADMIN_CREDENTIALS and ADMIN_CREDENTIALS[username]['password'] == password:
             # Create or update admin user in database
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             
             # Check if admin user exists in database
@@ -761,7 +733,6 @@ def admin_login():
                 user_id = existing_admin[0]
                 # Check if admin is approved and not banned
                 if not existing_admin[1] or existing_admin[2]:
-                    conn.close()
                     return render_template('admin_login.html', error="Admin account is disabled. Please contact system administrator.")
             else:
                 # Create new admin user in database
@@ -775,7 +746,6 @@ def admin_login():
                     c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
                     conn.commit()
                 except sqlite3.IntegrityError:
-                    conn.close()
                     return render_template('admin_login.html', error="Admin account creation failed.")
             
             # Set session variables
@@ -792,7 +762,6 @@ def admin_login():
             c.execute("UPDATE users SET last_login = ?, is_online = TRUE WHERE id = ?", 
                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
             conn.commit()
-            conn.close()
             
             flash('Admin login successful!')
             return redirect(url_for('admin_users'))
@@ -805,7 +774,7 @@ def admin_login():
 @login_required
 @role_required(['admin'])
 def admin_users():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Get all users with their approval and ban status
@@ -816,8 +785,6 @@ def admin_users():
     """)
     users = c.fetchall()
     
-    conn.close()
-    
     # Convert to list of dictionaries for easier template handling
     user_list = []
     for user in users:
@@ -838,12 +805,11 @@ def admin_users():
 @login_required
 @role_required(['admin'])
 def approve_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("UPDATE users SET approved = TRUE WHERE id = ?", (user_id,))
     conn.commit()
-    conn.close()
     
     flash('User approved successfully!')
     return redirect(url_for('admin_users'))
@@ -852,13 +818,12 @@ def approve_user(user_id):
 @login_required
 @role_required(['admin'])
 def reject_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("DELETE FROM users WHERE id = ?", (user_id,))
     c.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
     conn.commit()
-    conn.close()
     
     flash('User rejected and removed from system!')
     return redirect(url_for('admin_users'))
@@ -870,7 +835,7 @@ def ban_user(user_id):
     if request.method == 'POST':
         ban_reason = request.form.get('ban_reason', 'No reason provided')
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Ban the user
@@ -886,17 +851,14 @@ def ban_user(user_id):
         c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
         username = c.fetchone()[0]
         
-        conn.close()
-        
         flash(f'User {username} has been banned successfully!')
         return redirect(url_for('admin_users'))
     
     # GET request - show ban form
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         flash('User not found!')
@@ -912,7 +874,7 @@ def serve_uploaded_file(filename):
 @login_required
 @role_required(['admin'])
 def unban_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Unban the user
@@ -925,8 +887,6 @@ def unban_user(user_id):
     c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
     username = c.fetchone()[0]
     
-    conn.close()
-    
     flash(f'User {username} has been unbanned successfully!')
     return redirect(url_for('admin_users'))
 
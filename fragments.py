@@ -0,0 +1,91 @@
+import json
+import threading
+from collections import OrderedDict
+
+# orjson is optional: it encodes several times faster than the json module,
+# but the output is equivalent either way
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_backends():
+    return ['json', 'orjson'] if orjson is not None else ['json']
+
+
+def make_encoder(backend='auto'):
+    if backend == 'auto':
+        backend = 'orjson' if orjson is not None else 'json'
+    if backend == 'orjson':
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        return backend, orjson.dumps
+    if backend == 'json':
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        return backend, lambda obj: encoder.encode(obj).encode()
+    raise ValueError(f"Unknown JSON backend {backend}")
+
+
+# Each message's encoded JSON, kept by message id, so a list response is the
+# cached fragments joined together instead of a fresh jsonify of every dict.
+#
+# A fragment is reused only for the same dict (messages from the recent
+# buffer, which are replaced rather than changed) or an equal one (messages
+# just read from the database), so a stale fragment is never sent even if an
+# invalidation is missed; invalidate() on edit and delete just frees it early.
+# That check also makes a time-to-live unnecessary, so this is a plain LRU,
+# looked up once per list rather than once per message.
+class MessageFragments:
+    def __init__(self, maxsize=20000, backend='auto'):
+        self.backend, self._dumps = make_encoder(backend)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # The JSON array of messages, as bytes
+    def encode_list(self, messages):
+        fragments = [None] * len(messages)
+        missing = []
+        with self._lock:
+            entries = self._entries
+            for i, message in enumerate(messages):
+                entry = entries.get(message['id'])
+                if entry is not None and (entry[0] is message or entry[0] == message):
+                    fragments[i] = entry[1]
+                    entries.move_to_end(message['id'])
+                else:
+                    missing.append(i)
+            self.hits += len(messages) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            dumps = self._dumps
+            for i in missing:
+                fragments[i] = dumps(messages[i])
+            with self._lock:
+                for i in missing:
+                    self._entries[messages[i]['id']] = (messages[i], fragments[i])
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return b'[' + b','.join(fragments) + b']'
+
+    def invalidate(self, message_id):
+        with self._lock:
+            self._entries.pop(message_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'backend': self.backend,
+            }
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import socket
+import threading
+import logging
+from contextlib import nullcontext
+
+from flask import has_app_context
+
+from background import PerProcess
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+
+# Raised by a job handler when running the job again cannot succeed (say, a
+# file that is not a valid image); the job is failed without further retries
+class PermanentJobError(Exception):
+    pass
+
+
+# Durable background jobs kept in the jobs table of the application database,
+# so no broker is needed and queued work survives a restart. Routes enqueue
+# after their own transaction has committed; a pool of worker threads in each
+# process claims due jobs, retrying failures with exponential backoff.
+#
+# With JOB_QUEUE_INLINE set, jobs run immediately in the enqueuing thread,
+# which keeps tests and one-off scripts deterministic.
+class JobQueue:
+    def __init__(self, app):
+        self.app = app
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOB_RETRY_DELAY', 5.0)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+        app.config.setdefault('JOB_TIMEOUT', 300)
+        app.config.setdefault('JOB_RETENTION', 7 * 24 * 3600)
+        app.config.setdefault('JOB_QUEUE_INLINE', False)
+        self._handlers = {}
+        self._process = PerProcess()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._last_housekeeping = 0.0
+
+    def task(self, name):
+        def decorator(f):
+            self._handlers[name] = f
+            return f
+        return decorator
+
+    def enqueue(self, name, delay=0, **payload):
+        if name not in self._handlers:
+            raise LookupError(f"No handler registered for job {name}")
+        now = time.time()
+        with self._context():
+            conn = get_db()
+            # The row must not ride on (or commit) the caller's transaction
+            if conn.in_transaction:
+                raise RuntimeError(f"Job {name} enqueued inside an open transaction; commit first")
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO jobs (name, payload, status, attempts, max_attempts, run_after, created_at, updated_at)
+                VALUES (?, ?, 'queued', 0, ?, ?, ?, ?)
+            """, (name, json.dumps(payload), self.app.config['JOB_MAX_ATTEMPTS'], now + delay, now, now))
+            job_id = c.lastrowid
+            conn.commit()
+
+        if self.app.config['JOB_QUEUE_INLINE']:
+            self.run_inline(job_id)
+        else:
+            self.start()
+            with self._wakeup:
+                self._wakeup.notify()
+        return job_id
+
+    # The caller's app context when there is one (a request enqueueing after
+    # its commit), so a request never holds a second pooled connection and
+    # several of them cannot starve the pool; a new one otherwise
+    def _context(self):
+        return nullcontext() if has_app_context() else self.app.app_context()
+
+    # Runs a job and all of its retries right away, ignoring backoff
+    def run_inline(self, job_id):
+        with self._context():
+            while True:
+                job = self._claim(job_id)
+                if job is None or self._execute(job) != 'queued':
+                    return
+
+    def start(self):
+        if not self.app.config['JOB_QUEUE_INLINE']:
+            self._process.run(self._start)
+
+    def _start(self):
+        for i in range(self.app.config['JOB_WORKERS']):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    def _work(self):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        while True:
+            try:
+                with self.app.app_context():
+                    self._housekeeping()
+                    job = self._claim(worker_id=worker_id)
+                    if job is not None:
+                        self._execute(job)
+                        continue
+            except Exception:
+                logger.exception("Job worker error")
+            with self._wakeup:
+                self._wakeup.wait(self.app.config['JOB_POLL_INTERVAL'])
+
+    # Marks the next due job (or the given one) as running; the conditional
+    # update makes the claim safe between threads and processes
+    def _claim(self, job_id=None, worker_id='inline'):
+        conn = get_db()
+        c = conn.cursor()
+        now = time.time()
+        while True:
+            if job_id is None:
+                c.execute("""
+                    SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+                    ORDER BY run_after, id LIMIT 1
+                """, (now,))
+                row = c.fetchone()
+                if row is None:
+                    return None
+                candidate = row[0]
+            else:
+                candidate = job_id
+            c.execute("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, locked_at = ?, updated_at = ?
+                WHERE id = ? AND status = 'queued'
+            """, (worker_id, now, now, candidate))
+            claimed = c.rowcount == 1
+            conn.commit()
+            if claimed:
+                c.execute("SELECT id, name, payload, attempts, max_attempts FROM jobs WHERE id = ?", (candidate,))
+                return c.fetchone()
+            if job_id is not None:
+                return None
+
+    def _execute(self, job):
+        job_id, name, payload, attempts, max_attempts = job
+        conn = get_db()
+        try:
+            handler = self._handlers.get(name)
+            if handler is None:
+                raise PermanentJobError(f"No handler registered for job {name}")
+            handler(**json.loads(payload))
+        except Exception as e:
+            conn.rollback()
+            error = f"{type(e).__name__}: {e}"
+            now = time.time()
+            if attempts < max_attempts and not isinstance(e, PermanentJobError):
+                status = 'queued'
+                run_after = now + self.app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+            else:
+                status = 'failed'
+                run_after = now
+            logger.warning("Job %s (%s) attempt %d failed: %s", job_id, name, attempts, error)
+            conn.execute("""
+                UPDATE jobs SET status = ?, run_after = ?, last_error = ?, locked_by = NULL, updated_at = ?
+                WHERE id = ?
+            """, (status, run_after, error, now, job_id))
+        else:
+            status = 'done'
+            conn.execute("""
+                UPDATE jobs SET status = 'done', locked_by = NULL, updated_at = ? WHERE id = ?
+            """, (time.time(), job_id))
+        conn.commit()
+        return status
+
+    # Requeues jobs whose worker died mid-run and drops old finished ones;
+    # runs every 30 poll intervals or so in each process
+    def _housekeeping(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_housekeeping < self.app.config['JOB_POLL_INTERVAL'] * 30:
+                return
+            self._last_housekeeping = now
+        conn = get_db()
+        stale = now - self.app.config['JOB_TIMEOUT']
+        conn.execute("""
+            UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                            last_error = 'Timed out', locked_by = NULL, updated_at = ?
+            WHERE status = 'running' AND locked_at < ?
+        """, (now, stale))
+        conn.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?",
+                     (now - self.app.config['JOB_RETENTION'],))
+        conn.commit()
+
+    def retry(self, job_id):
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("""
+            UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ?
+            WHERE id = ? AND status = 'failed'
+        """, (time.time(), time.time(), job_id))
+        retried = c.rowcount == 1
+        conn.commit()
+        if retried and self.app.config['JOB_QUEUE_INLINE']:
+            self.run_inline(job_id)
+        elif retried:
+            self.start()
+            with self._wakeup:
+                self._wakeup.notify()
+        return retried
+
+    def stats(self, recent=20):
+        c = get_db().cursor()
+        c.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        counts = dict(c.fetchall())
+        c.execute("SELECT MIN(run_after) FROM jobs WHERE status = 'queued'")
+        oldest = c.fetchone()[0]
+        c.execute("""
+            SELECT id, name, payload, status, attempts, max_attempts, last_error, created_at, updated_at
+            FROM jobs WHERE status != 'done' ORDER BY id DESC LIMIT ?
+        """, (recent,))
+        jobs = [{
+            'id': row[0],
+            'name': row[1],
+            'payload': json.loads(row[2]),
+            'status': row[3],
+            'attempts': row[4],
+            'max_attempts': row[5],
+            'last_error': row[6],
+            'created_at': row[7],
+            'updated_at': row[8]
+        } for row in c.fetchall()]
+        return {
+            'counts': {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')},
+            'oldest_queued_age': max(0.0, time.time() - oldest) if oldest else None,
+            'workers': 0 if self.app.config['JOB_QUEUE_INLINE'] else self.app.config['JOB_WORKERS'],
+            'handlers': sorted(self._handlers),
+            'jobs': jobs
+        }
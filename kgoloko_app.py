@@ -1,25 +1,238 @@
 import os
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file as werkzeug_send_file
+from werkzeug.exceptions import NotFound
 import sqlite3
 from datetime import datetime, timedelta
 import uuid
+import mimetypes
 import json
 import logging
 from functools import wraps
 import random
+import sys
+import re
+import html
+import time
+import hashlib
+from queue import Empty
+from database import init_pool, get_db, get_pool, pragma_report, GroupCommitWriter, SQLITE_HAS_RETURNING
+from realtime import EventHub, RoomStream, create_bus, parse_event_id, SSE_KEEPALIVE
+import tempfile
+from cache import TTLCache
+from rooms import RoomRegistry
+from recent import RecentMessages
+from fragments import MessageFragments
+from jobs import JobQueue, PermanentJobError
+from presence import PresenceTracker
+from media import preview_supported, preview_name, create_preview, PreviewError
+from uploads import UploadRequest, ResumableUploads, UploadError, store as store_upload, install_blob, discard_temp, blob_hash, hash_file
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['BATCH_MAX_MESSAGES'] = 500  # per /send_messages request
+# Uploads are streamed to files here while the request is parsed, then renamed
+# into UPLOAD_FOLDER, so this must be on the same filesystem
+app.config['UPLOAD_TMP_FOLDER'] = 'uploads_tmp'
+# Larger files (videos) go through the resumable /uploads endpoints in pieces
+# of at most MAX_CONTENT_LENGTH each
+app.config['RESUMABLE_UPLOAD_MAX_SIZE'] = 512 * 1024 * 1024
+app.config['RESUMABLE_UPLOAD_TTL'] = 24 * 3600
+# Stored files are named by content hash and never change, so browsers may
+# keep them for a year; files from before that are revalidated by ETag
+app.config['UPLOAD_CACHE_MAX_AGE'] = 365 * 24 * 3600
+# Hand file bodies to a front proxy: None, 'x-sendfile' (Apache, lighttpd) or
+# 'x-accel-redirect' (nginx, with an internal location at the prefix below
+# aliased to UPLOAD_FOLDER)
+app.config['UPLOAD_SENDFILE'] = None
+app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] = '/protected-uploads/'
+app.request_class = UploadRequest
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mov', 'avi', 'wav', 'mp3', 'ogg' , 'blob', 'pdf', 'txt', 'doc', 'docx'}
 
-# Ensure the upload folder exists
+# Ensure the upload folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_TMP_FOLDER'], exist_ok=True)
+
+# Thumbnails and video poster frames (longest side, pixels), made by a
+# background job after an image or video is sent
+app.config['THUMBNAIL_SIZE'] = 320
+
+# Content hashes of files saved before the content-addressed store, keyed by
+# (name, mtime, size) so a replaced file gets a fresh one
+legacy_etag_cache = TTLCache(maxsize=10000, ttl=24 * 3600)
+
+resumable_uploads = ResumableUploads(app.config['UPLOAD_TMP_FOLDER'],
+                                     app.config['RESUMABLE_UPLOAD_MAX_SIZE'],
+                                     app.config['RESUMABLE_UPLOAD_TTL'])
 
 app.secret_key = 'your-secure-secret-key-here'  # Change this to a secure random key
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 
+# Pooled SQLite connections, one per app context (see database.py)
+app.config['DATABASE'] = 'chatdatabase.db'
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_POOL_TIMEOUT'] = 10.0
+# Connection PRAGMAs; WAL lets readers keep polling while a message is written
+app.config['DB_JOURNAL_MODE'] = 'WAL'
+app.config['DB_SYNCHRONOUS'] = 'NORMAL'
+app.config['DB_CACHE_SIZE_KB'] = 16 * 1024
+app.config['DB_MMAP_SIZE'] = 64 * 1024 * 1024
+app.config['DB_TEMP_STORE'] = 'MEMORY'
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+init_pool(app)
+
+# Server-Sent Events streams (/stream/<room>). Streams end after
+# STREAM_MAX_SECONDS so sync gunicorn workers are not held past their timeout;
+# the browser reconnects and resumes from Last-Event-ID.
+#
+# The chat page only opens streams when LIVE_STREAM is on, which asgi.py does:
+# under sync workers every open tab would hold a worker, so they poll instead.
+app.config['LIVE_STREAM'] = False
+app.config['STREAM_MAX_SECONDS'] = 25
+app.config['STREAM_KEEPALIVE_SECONDS'] = 10
+app.config['STREAM_RETRY_MS'] = 1000
+app.config['STREAM_REPLAY_LIMIT'] = 500
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+event_hub = EventHub()
+
+# Broadcast of room events and cache invalidations between worker processes.
+# 'local' only reaches the current process; use 'unix' when running several
+# gunicorn workers so every worker sees every event. The socket directory is
+# named after the database, so two deployments on one host (which share room
+# names like 'general') never see each other's events.
+app.config['EVENT_BUS'] = 'local'
+app.config['EVENT_BUS_DIR'] = os.path.join(
+    tempfile.gettempdir(),
+    f"kgoloko_bus_{hashlib.sha1(os.path.abspath(app.config['DATABASE']).encode()).hexdigest()[:12]}")
+event_bus = create_bus(app.config['EVENT_BUS'], app.config['EVENT_BUS_DIR'])
+event_bus.subscribe('room', lambda data: event_hub.publish(data['room'], data['event']))
+
+# (approved, banned, ban_reason) per user id, read by approval_required.
+# Admin actions invalidate entries in every worker through the event bus;
+# the TTL bounds how long a missed invalidation can leave a ban unenforced.
+app.config['USER_STATUS_CACHE_TTL'] = 30
+app.config['USER_STATUS_CACHE_SIZE'] = 10000
+user_status_cache = TTLCache(maxsize=app.config['USER_STATUS_CACHE_SIZE'],
+                             ttl=app.config['USER_STATUS_CACHE_TTL'])
+event_bus.subscribe('user', lambda data: user_status_cache.delete(data['user_id']))
+# Open streams only check access when they open, so they are ended as well;
+# the reconnect then re-runs the checks against the new status
+event_bus.subscribe('user', lambda data: event_hub.end_user(data['user_id']))
+
+# Room ACLs, loaded once per worker and reloaded when a 'rooms' event arrives
+app.config['ROOM_REGISTRY_TTL'] = 300
+room_registry = RoomRegistry(ttl=app.config['ROOM_REGISTRY_TTL'])
+event_bus.subscribe('rooms', lambda data: room_registry.invalidate())
+
+# (last message id, last change id) per room, the validator behind the ETags
+# of the room read endpoints. Dropped in every worker by the room event each
+# send, edit and delete publishes; the TTL bounds staleness from a lost event.
+app.config['ROOM_VERSION_CACHE_TTL'] = 10
+app.config['ROOM_VERSION_CACHE_SIZE'] = 10000
+room_version_cache = TTLCache(maxsize=app.config['ROOM_VERSION_CACHE_SIZE'],
+                              ttl=app.config['ROOM_VERSION_CACHE_TTL'])
+event_bus.subscribe('room', lambda data: room_version_cache.delete(data['room']))
+
+# The latest RECENT_MESSAGES_PER_ROOM messages of recently read rooms, so
+# get_messages can answer the usual "last 50" read without SQL (see
+# recent.py). Buffers only take what is read from the database; a room event
+# just drops the room's cached version, and the next read catches the buffer
+# up. Memory is capped by room count and by an estimate of the bytes held.
+app.config['RECENT_MESSAGES_PER_ROOM'] = 200
+app.config['RECENT_MESSAGES_MAX_ROOMS'] = 64
+app.config['RECENT_MESSAGES_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['RECENT_MESSAGES_TTL'] = 60
+recent_messages = RecentMessages(lambda text: make_reply_preview(text, 'text'),
+                                 per_room=app.config['RECENT_MESSAGES_PER_ROOM'],
+                                 max_rooms=app.config['RECENT_MESSAGES_MAX_ROOMS'],
+                                 max_bytes=app.config['RECENT_MESSAGES_MAX_BYTES'],
+                                 ttl=app.config['RECENT_MESSAGES_TTL'])
+
+# Encoded JSON per message for get_messages (see fragments.py). JSON_BACKEND
+# is 'auto' (orjson when installed), 'orjson' or 'json'.
+app.config['JSON_BACKEND'] = 'auto'
+app.config['MESSAGE_FRAGMENT_CACHE_SIZE'] = 20000
+message_fragments = MessageFragments(maxsize=app.config['MESSAGE_FRAGMENT_CACHE_SIZE'],
+                                     backend=app.config['JSON_BACKEND'])
+
+def drop_changed_fragment(data):
+    if data['event']['type'] != 'message':
+        message_fragments.invalidate(data['event']['data']['id'])
+
+event_bus.subscribe('room', drop_changed_fragment)
+event_bus.subscribe('preview', lambda data: recent_messages.set_thumbnail(data['file_path'], data['thumbnail_path']))
+
+# Background jobs (see jobs.py): slow side effects such as previews and file
+# removal run on worker threads; JOB_QUEUE_INLINE runs them in the request
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 5.0
+app.config['JOB_QUEUE_INLINE'] = False
+job_queue = JobQueue(app)
+
+# Group commit for send_message (see GroupCommitWriter): concurrent inserts
+# arriving within GROUP_COMMIT_MAX_LATENCY_MS share one transaction and one
+# fsync. Off by default; worth it when many users post at the same moment.
+app.config['GROUP_COMMIT'] = False
+app.config['GROUP_COMMIT_MAX_LATENCY_MS'] = 2
+app.config['GROUP_COMMIT_MAX_BATCH'] = 256
+group_writer = GroupCommitWriter(lambda: get_pool(app).connect(),
+                                 max_latency=app.config['GROUP_COMMIT_MAX_LATENCY_MS'] / 1000,
+                                 max_batch=app.config['GROUP_COMMIT_MAX_BATCH'])
+
+# Presence (see presence.py): clients POST /heartbeat every
+# PRESENCE_HEARTBEAT_SECONDS and drop off the online lists PRESENCE_TTL
+# seconds after their last one. Heartbeats reach every worker through the
+# event bus; last-seen times are written in batches every
+# PRESENCE_FLUSH_SECONDS.
+app.config['PRESENCE_TTL'] = 45
+app.config['PRESENCE_HEARTBEAT_SECONDS'] = 20
+app.config['PRESENCE_FLUSH_SECONDS'] = 30
+# Changes kept for get_online_users?since= deltas; older versions get the full list
+app.config['PRESENCE_LOG_SIZE'] = 1000
+presence = PresenceTracker(ttl=app.config['PRESENCE_TTL'], log_size=app.config['PRESENCE_LOG_SIZE'])
+
+# Join/leave deltas go to the open streams in this worker: changes to the
+# global list to every stream, room changes to that room's streams
+def push_presence_changes(changes):
+    for change in changes:
+        event = {'type': 'presence', 'data': change}
+        if change['room'] is None:
+            event_hub.broadcast(event)
+        else:
+            event_hub.publish(change['room'], event)
+
+def apply_presence(data):
+    if data['op'] == 'beat':
+        changes = presence.beat(data['user_id'], data['username'], data['role'], data['room'], data['time'])
+    else:
+        changes = presence.leave(data['user_id'])
+    push_presence_changes(changes)
+
+event_bus.subscribe('presence', apply_presence)
+
+def flush_last_seen(last_seen):
+    with app.app_context():
+        conn = get_db()
+        conn.executemany("UPDATE users SET last_seen = ? WHERE id = ?", [
+            (datetime.fromtimestamp(seen).strftime('%Y-%m-%d %H:%M:%S'), user_id)
+            for user_id, seen in last_seen.items()
+        ])
+        conn.commit()
+
+# Each service starts its threads (and sockets) once per process, so this
+# also starts them in every worker forked after the app was imported
+@app.before_request
+def start_background_services():
+    event_bus.start()
+    job_queue.start()
+    presence.start(push_presence_changes, flush_last_seen, app.config['PRESENCE_FLUSH_SECONDS'])
+    if app.config['GROUP_COMMIT']:
+        group_writer.start()
+
 # Helper function to generate a unique 7-digit ID
 def generate_unique_id(cursor):
     while True:
@@ -48,9 +261,428 @@ def get_file_type(filename):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Message rows with their reply preview resolved through a self-join on reply_to
+MESSAGE_SELECT = """
+    SELECT m.id, m.username, m.message, m.message_type, m.file_path, m.timestamp, m.is_edited, m.edited_at, m.reply_to,
+           r.username, r.message, r.message_type, m.file_name, u.thumbnail_path
+    FROM messages m
+    LEFT JOIN messages r ON r.id = m.reply_to
+    LEFT JOIN uploads u ON u.file_path = m.file_path
+"""
+
+def message_from_row(row):
+    message = {
+        'id': row[0],
+        'username': row[1],
+        'message': row[2],
+        'message_type': row[3],
+        'file_path': row[4],
+        'timestamp': row[5],
+        'is_edited': bool(row[6]),
+        'edited_at': row[7],
+        'reply_to': row[8],
+        'file_name': row[12],
+        'thumbnail_path': row[13]
+    }
+    if message['reply_to'] and row[9] is not None:
+        message['reply_username'] = row[9]
+        message['reply_preview'] = make_reply_preview(row[10], row[11])
+    return message
+
+def change_from_row(row):
+    return {
+        'change_id': row[0],
+        'id': row[1],
+        'type': row[2],
+        'message': row[3],
+        'edited_at': row[4]
+    }
+
+# Edits and deletes are recorded in message_changes so pollers can pick them up
+def record_message_change(c, room, message_id, change_type, message=None, edited_at=None):
+    c.execute("""
+        INSERT INTO message_changes (room, message_id, change_type, message, edited_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (room, message_id, change_type, message, edited_at))
+    return change_from_row((c.lastrowid, message_id, change_type, message, edited_at))
+
+# Messages newer than after_id and changes newer than change_id, oldest first
+# and at most limit of each; has_more is set when either was cut short
+def fetch_room_updates(c, room, after_id, change_id, limit):
+    c.execute(MESSAGE_SELECT + """
+        WHERE m.room = ? AND m.id > ? 
+        ORDER BY m.id ASC 
+        LIMIT ?
+    """, (room, after_id, limit + 1))
+    rows = c.fetchall()
+    has_more = len(rows) > limit
+    messages = [message_from_row(row) for row in rows[:limit]]
+    
+    c.execute("""
+        SELECT id, message_id, change_type, message, edited_at
+        FROM message_changes 
+        WHERE room = ? AND id > ? 
+        ORDER BY id ASC
+        LIMIT ?
+    """, (room, change_id, limit + 1))
+    rows = c.fetchall()
+    has_more = has_more or len(rows) > limit
+    changes = [change_from_row(row) for row in rows[:limit]]
+    return messages, changes, has_more
+
+# Search terms become quoted FTS5 prefix queries, so user input can never be
+# parsed as FTS syntax: 'home work' matches "home"* AND "work"*
+def make_fts_query(query):
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', query))
+
+# Snippet highlights are marked with private-use characters inside SQLite and
+# turned into <mark> tags only after the message text has been escaped
+SNIPPET_START, SNIPPET_END = '\ue000', '\ue001'
+
+def render_snippet(snippet):
+    return html.escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+SEARCH_SELECT = """
+    SELECT m.id, m.username, m.message, m.message_type, m.file_path, m.timestamp, m.is_edited, m.edited_at, m.reply_to,
+           r.username, r.message, r.message_type, m.file_name, u.thumbnail_path,
+           m.room, messages_fts.rank, snippet(messages_fts, 0, char(57344), char(57345), '...', 16)
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    LEFT JOIN messages r ON r.id = m.reply_to
+    LEFT JOIN uploads u ON u.file_path = m.file_path
+"""
+
+def search_result_from_row(row, snippet):
+    message = message_from_row(row)
+    message['room'] = row[14]
+    message['snippet'] = snippet
+    return message
+
+# Ranked (bm25) or newest-first full-text search over one or more rooms.
+# Paging is keyset-based: the cursor is "<rank>:<id>" for ranked results and
+# "<id>" for newest-first, so deep pages cost the same as the first.
+def search_fts(c, rooms, query, sort, cursor, limit):
+    fts_query = make_fts_query(query)
+    if not fts_query or not rooms:
+        return [], None
+    
+    params = [fts_query] + rooms
+    where = ""
+    if sort == 'recent':
+        if cursor:
+            where = " AND m.id < ?"
+            params.append(int(cursor))
+        order = "m.id DESC"
+    else:
+        if cursor:
+            rank, last_id = cursor.rsplit(':', 1)
+            where = " AND (messages_fts.rank, m.id) > (?, ?)"
+            params += [float(rank), int(last_id)]
+        order = "messages_fts.rank, m.id"
+    
+    c.execute(SEARCH_SELECT + f"""
+        WHERE messages_fts MATCH ? AND m.room IN ({', '.join('?' * len(rooms))}){where}
+        ORDER BY {order}
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = c.fetchall()
+    results = [search_result_from_row(row, render_snippet(row[16])) for row in rows[:limit]]
+    
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = str(last[0]) if sort == 'recent' else f"{last[15]!r}:{last[0]}"
+    return results, next_cursor
+
+# Fallback for SQLite builds without FTS5: unindexed LIKE scan, newest first
+def search_like(c, rooms, query, cursor, limit):
+    if not rooms:
+        return [], None
+    params = rooms + [f'%{query}%']
+    where = ""
+    if cursor:
+        where = " AND m.id < ?"
+        params.append(int(cursor))
+    c.execute(f"""
+        SELECT m.id, m.username, m.message, m.message_type, m.file_path, m.timestamp, m.is_edited, m.edited_at, m.reply_to,
+               r.username, r.message, r.message_type, m.file_name, u.thumbnail_path, m.room
+        FROM messages m
+        LEFT JOIN messages r ON r.id = m.reply_to
+        LEFT JOIN uploads u ON u.file_path = m.file_path
+        WHERE m.room IN ({', '.join('?' * len(rooms))}) AND m.message LIKE ?{where}
+        ORDER BY m.id DESC
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = c.fetchall()
+    results = [search_result_from_row(row, html.escape(row[2])) for row in rows[:limit]]
+    
+    next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+    return results, next_cursor
+
+# Matches per room for a cross-room search, from the same index
+def count_search_hits(c, rooms, query):
+    if not rooms:
+        return {}
+    if fts_enabled:
+        fts_query = make_fts_query(query)
+        if not fts_query:
+            return {}
+        c.execute(f"""
+            SELECT m.room, COUNT(*)
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND m.room IN ({', '.join('?' * len(rooms))})
+            GROUP BY m.room
+        """, [fts_query] + rooms)
+    else:
+        c.execute(f"""
+            SELECT room, COUNT(*)
+            FROM messages
+            WHERE room IN ({', '.join('?' * len(rooms))}) AND message LIKE ?
+            GROUP BY room
+        """, rooms + [f'%{query}%'])
+    return dict(c.fetchall())
+
+def get_last_message_id(c, room):
+    c.execute("SELECT MAX(id) FROM messages WHERE room = ?", (room,))
+    return c.fetchone()[0] or 0
+
+# Committed room changes go to every stream open on that room, in every worker
+def publish_room_event(room, event_type, data):
+    event_bus.publish('room', {'room': room, 'event': {'type': event_type, 'data': data}})
+
+# Tells every worker that a user's account status changed
+def publish_user_changed(user_id):
+    event_bus.publish('user', {'user_id': user_id})
+
+# Takes a user off the online lists in every worker (logout, ban)
+def publish_presence_leave(user_id):
+    event_bus.publish('presence', {'op': 'leave', 'user_id': user_id})
+
+def get_last_change_id(c, room):
+    c.execute("SELECT MAX(id) FROM message_changes WHERE room = ?", (room,))
+    return c.fetchone()[0] or 0
+
+# Moves on every send, edit and delete in the room. Previews made later by
+# generate_preview do not move it, so a revalidated copy can lack a thumbnail
+# (and show the full image) until the room next changes.
+def get_room_version(room):
+    generation = room_version_cache.generation
+    version = room_version_cache.get(room)
+    if version is None:
+        c = get_db().cursor()
+        version = (get_last_message_id(c, room), get_last_change_id(c, room))
+        room_version_cache.set_if_current(room, version, generation)
+    return version
+
+# Messages for a get_messages read from the recent-message buffer, bringing it
+# up to date from the database first if needed; None when the read has to go
+# to SQL (an older page, or more than the buffer holds)
+def read_recent_messages(room, version, limit, before_id, after_id):
+    messages = recent_messages.get(room, version, limit, before_id, after_id)
+    if messages is not None or limit > recent_messages.per_room:
+        return messages
+    
+    c = get_db().cursor()
+    state = recent_messages.state(room)
+    if state is not None:
+        new_messages, changes, has_more = fetch_room_updates(c, room, state[0], state[1],
+                                                             recent_messages.per_room)
+        if not has_more:
+            # False only if another read caught the buffer up first
+            recent_messages.catch_up(room, state, new_messages, changes)
+            return recent_messages.get(room, version, limit, before_id, after_id)
+    
+    # No buffer yet, or too far behind to catch up
+    last_change_id = get_last_change_id(c, room)
+    c.execute(MESSAGE_SELECT + """
+        WHERE m.room = ? 
+        ORDER BY m.id DESC 
+        LIMIT ?
+    """, (room, recent_messages.per_room))
+    recent_messages.load(room, [message_from_row(row) for row in c.fetchall()[::-1]], last_change_id)
+    return recent_messages.get(room, version, limit, before_id, after_id)
+
+# A list of messages as a JSON response, from their cached fragments
+def messages_response(messages):
+    return app.response_class(message_fragments.encode_list(messages), mimetype='application/json')
+
+# Conditional GET for the JSON read endpoints: the ETag is a hash of a cheap
+# validator and everything else the body depends on, so a matching
+# If-None-Match is answered before the main query runs or any JSON is built
+def json_etag(*parts):
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:24]
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
+    return None
+
+# Counts a new message referencing blob and returns the file's preview, if
+# one was already made. Runs inside the message's write transaction, so it is
+# serialized against remove_upload: the file is moved into place here, and
+# put back if the last other reference was deleted after the upload arrived.
+def add_upload_reference(c, blob, file_path):
+    upsert = """
+        INSERT INTO uploads (file_path, sha256, size, ref_count) VALUES (?, ?, ?, 1)
+        ON CONFLICT(file_path) DO UPDATE SET ref_count = ref_count + 1
+    """
+    if SQLITE_HAS_RETURNING:
+        c.execute(upsert + " RETURNING thumbnail_path", (file_path, blob.sha256, blob.size))
+    else:
+        c.execute(upsert, (file_path, blob.sha256, blob.size))
+        c.execute("SELECT thumbnail_path FROM uploads WHERE file_path = ?", (file_path,))
+    thumbnail_path = c.fetchone()[0]
+    install_blob(blob)
+    return thumbnail_path
+
+# Drops one reference to a stored file. Returns True when that was the last
+# one, in which case the caller queues remove_upload once it has committed.
+def release_upload(c, file_path):
+    c.execute("UPDATE uploads SET ref_count = ref_count - 1 WHERE file_path = ?", (file_path,))
+    if c.rowcount:
+        c.execute("DELETE FROM uploads WHERE file_path = ? AND ref_count <= 0", (file_path,))
+        return c.rowcount > 0
+    # No row: the file predates the store and belongs to this message alone
+    return True
+
+@job_queue.task('remove_upload')
+def remove_upload(file_path):
+    conn = get_db()
+    c = conn.cursor()
+    # The write lock is taken before looking, which serializes this against a
+    # send re-adding a reference (see add_upload_reference)
+    c.execute("DELETE FROM uploads WHERE file_path = ? AND ref_count <= 0", (file_path,))
+    c.execute("SELECT 1 FROM uploads WHERE file_path = ?", (file_path,))
+    if c.fetchone() is not None:
+        conn.commit()
+        return
+    
+    name = file_path.split('/')[-1]
+    path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+    if os.path.exists(path):
+        os.remove(path)
+    if blob_hash(name):
+        remove_unused_preview(c, blob_hash(name))
+    conn.commit()
+
+# Previews are named after the content hash alone, so the same file stored
+# under two extensions (x.jpg, x.jpeg) shares one; it is removed once no
+# stored file with that content is left. Call with the write lock held.
+def remove_unused_preview(c, sha256):
+    c.execute("SELECT 1 FROM uploads WHERE sha256 = ? LIMIT 1", (sha256,))
+    if c.fetchone() is None:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], preview_name(sha256))
+        if os.path.exists(path):
+            os.remove(path)
+
+# Makes the thumbnail (image) or poster frame (video) for a stored upload
+# and records it on the upload
+@job_queue.task('generate_preview')
+def generate_preview(file_path, kind):
+    name = file_path.split('/')[-1]
+    source = os.path.join(app.config['UPLOAD_FOLDER'], name)
+    if not os.path.exists(source):
+        return
+    preview = preview_name(blob_hash(name))
+    dest = os.path.join(app.config['UPLOAD_FOLDER'], preview)
+    if not os.path.exists(dest):
+        try:
+            if not create_preview(kind, source, dest, app.config['THUMBNAIL_SIZE']):
+                return
+        except PreviewError as e:
+            # The file stays as sent, just without a preview
+            raise PermanentJobError(str(e))
+    
+    conn = get_db()
+    c = conn.cursor()
+    # The update takes the write lock, which serializes this against
+    # remove_upload removing the shared preview
+    c.execute("UPDATE uploads SET thumbnail_path = ? WHERE file_path = ?", (f"static/uploads/{preview}", file_path))
+    if not c.rowcount:
+        # Every message using the file was deleted in the meantime
+        remove_unused_preview(c, blob_hash(name))
+        conn.commit()
+        return
+    if not os.path.exists(dest):
+        # Removed along with the last other copy of this content since it
+        # was checked above; the retry makes it again
+        raise RuntimeError(f"Preview {preview} was removed before it was recorded")
+    conn.commit()
+    event_bus.publish('preview', {'file_path': file_path, 'thumbnail_path': f"static/uploads/{preview}"})
+
+def queue_preview(file_path, kind):
+    if preview_supported(kind):
+        job_queue.enqueue('generate_preview', file_path=file_path, kind=kind)
+
+# Writes one message (and its upload reference) on a cursor that is already
+# inside a write transaction. Returns (id, reply_to, reply_username,
+# reply_preview, thumbnail_path); reply_to is dropped if it names no message
+# in the room.
+def insert_message(c, room, username, message, message_type, timestamp, reply_to, file_path, file_name, blob):
+    reply_username = None
+    reply_preview = None
+    if reply_to:
+        c.execute("""
+            SELECT username, message, message_type 
+            FROM messages 
+            WHERE id = ? AND room = ?
+        """, (reply_to, room))
+        reply_data = c.fetchone()
+        if reply_data:
+            reply_username = reply_data[0]
+            reply_preview = make_reply_preview(reply_data[1], reply_data[2])
+        else:
+            reply_to = None
+    
+    insert = """
+        INSERT INTO messages (room, username, message, message_type, file_path, timestamp, reply_to, file_name) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    params = (room, username, message, message_type, file_path, timestamp, reply_to, file_name)
+    if SQLITE_HAS_RETURNING:
+        c.execute(insert + " RETURNING id", params)
+        message_id = c.fetchone()[0]
+    else:
+        c.execute(insert, params)
+        message_id = c.lastrowid
+    
+    thumbnail_path = add_upload_reference(c, blob, file_path) if blob is not None else None
+    return message_id, reply_to, reply_username, reply_preview, thumbnail_path
+
+# The upload of a message whose insert then failed. The insert may have moved
+# the file into place before failing; remove_upload keeps it if anything
+# else references it.
+def remove_orphaned_upload(blob, file_path):
+    if blob is None:
+        return
+    discard_temp(blob)
+    remove_upload(file_path)
+
+# Rows that belong to a removed user account
+@job_queue.task('purge_user_data')
+def purge_user_data(user_id):
+    conn = get_db()
+    conn.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
+    conn.commit()
+
+# Short preview of a replied-to message, shown above the reply
+def make_reply_preview(message, message_type):
+    if message_type in ['image', 'video', 'audio', 'document']:
+        return f"[{message_type.capitalize()} message]"
+    return message[:50] + ('...' if len(message) > 50 else '')
+
+# Set by init_db once the messages_fts table is known to exist
+fts_enabled = False
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Create users table with unique_id column
@@ -72,6 +704,7 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             last_login DATETIME,
             is_online BOOLEAN DEFAULT FALSE,
+            last_seen DATETIME,
             profile_picture TEXT DEFAULT 'default.png',
             FOREIGN KEY (banned_by) REFERENCES users(id)
         )''')
@@ -88,6 +721,12 @@ def init_db():
             unique_id = generate_unique_id(c)
             c.execute("UPDATE users SET unique_id = ? WHERE id = ?", (unique_id, user[0]))
     
+    # Add last_seen column (written by the presence flush) if it doesn't exist
+    try:
+        c.execute("SELECT last_seen FROM users LIMIT 1")
+    except sqlite3.OperationalError:
+        c.execute("ALTER TABLE users ADD COLUMN last_seen DATETIME")
+    
     # Create messages table
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
     if not c.fetchone():
@@ -102,9 +741,95 @@ def init_db():
             is_edited BOOLEAN DEFAULT FALSE,
             edited_at DATETIME,
             reply_to INTEGER,
+            file_name TEXT,
             FOREIGN KEY (reply_to) REFERENCES messages(id)
         )''')
     
+    # Original name of an attached file (stored files are named by content hash)
+    try:
+        c.execute("SELECT file_name FROM messages LIMIT 1")
+    except sqlite3.OperationalError:
+        c.execute("ALTER TABLE messages ADD COLUMN file_name TEXT")
+    
+    # Content-addressed upload store: one row per stored file, counting the
+    # messages that reference it. Files saved before this table existed have
+    # no row and belong to their single message.
+    c.execute('''CREATE TABLE IF NOT EXISTS uploads (
+        file_path TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        thumbnail_path TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    try:
+        c.execute("SELECT thumbnail_path FROM uploads LIMIT 1")
+    except sqlite3.OperationalError:
+        c.execute("ALTER TABLE uploads ADD COLUMN thumbnail_path TEXT")
+    # Previews are shared by every stored file with the same content
+    c.execute("CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256)")
+    
+    # Indexes for per-room history reads (keyset paging by id, legacy ordering by timestamp)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_timestamp ON messages (room, timestamp)")
+    
+    # Create message_changes table (edit/delete log read by incremental polling)
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='message_changes'")
+    if not c.fetchone():
+        c.execute('''CREATE TABLE message_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            change_type TEXT NOT NULL CHECK(change_type IN ('edit', 'delete')),
+            message TEXT,
+            edited_at DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_message_changes_room_id ON message_changes (room, id)")
+    
+    # Full-text index over message text, kept in step with messages by triggers
+    # (inserts from send_message, edits from edit_message, deletes from delete_message)
+    global fts_enabled
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+    fts_enabled = c.fetchone() is not None
+    if not fts_enabled:
+        try:
+            c.execute("""CREATE VIRTUAL TABLE messages_fts USING fts5(
+                message, content='messages', content_rowid='id', prefix='2 3'
+            )""")
+            c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            fts_enabled = True
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, falling back to LIKE: {e}")
+    if fts_enabled:
+        c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END""")
+    
+    # Background job queue (see jobs.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL CHECK(status IN ('queued', 'running', 'done', 'failed')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        run_after REAL NOT NULL,
+        last_error TEXT,
+        locked_by TEXT,
+        locked_at REAL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+    
     # Create rooms table
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='rooms'")
     if not c.fetchone():
@@ -132,6 +857,7 @@ def init_db():
         )''')
     
     # Insert default rooms
+    rooms_changed = False
     default_rooms = [
         ('general', 'General discussion room', '["student", "teacher", "parent", "admin"]', 'system'),
         ('teachers_students', 'Teacher-Student discussions', '["teacher", "student"]', 'system'),
@@ -143,6 +869,7 @@ def init_db():
         c.execute("SELECT id FROM rooms WHERE name = ?", (room[0],))
         if not c.fetchone():
             c.execute("INSERT INTO rooms (name, description, allowed_roles, created_by) VALUES (?, ?, ?, ?)", room)
+            rooms_changed = True
     
     # Check and add approved column
     try:
@@ -161,9 +888,13 @@ def init_db():
         c.execute("ALTER TABLE users ADD COLUMN banned_by INTEGER")
     
     conn.commit()
-    conn.close()
+    
+    if rooms_changed:
+        room_registry.invalidate()
 
-init_db()
+with app.app_context():
+    init_db()
+    print(f"Database settings: {pragma_report(get_db())}")
 
 # Decorators
 def login_required(f):
@@ -192,11 +923,16 @@ def approval_required(f):
         if 'user_id' not in session:
             return redirect(url_for('login', next=request.url))
         
-        conn = sqlite3.connect('chatdatabase.db')
-        c = conn.cursor()
-        c.execute("SELECT approved, banned FROM users WHERE id = ?", (session['user_id'],))
-        user = c.fetchone()
-        conn.close()
+        # A ban committed while the row is being read invalidates the cache
+        # first, and set_if_current then keeps the stale row out of it
+        generation = user_status_cache.generation
+        user = user_status_cache.get(session['user_id'])
+        if user is None:
+            c = get_db().cursor()
+            c.execute("SELECT approved, banned, ban_reason FROM users WHERE id = ?", (session['user_id'],))
+            user = c.fetchone()
+            if user:
+                user_status_cache.set_if_current(session['user_id'], user, generation)
         
         if not user:
             session.clear()
@@ -206,11 +942,7 @@ def approval_required(f):
             return "Your account is pending admin approval. Please wait.", 403
         
         if user[1]:
-            conn = sqlite3.connect('chatdatabase.db')
-            c = conn.cursor()
-            c.execute("SELECT ban_reason FROM users WHERE id = ?", (session['user_id'],))
-            ban_reason = c.fetchone()[0] or "No reason provided"
-            conn.close()
+            ban_reason = user[2] or "No reason provided"
             session.clear()
             return f"Your account has been banned. Reason: {ban_reason}", 403
         
@@ -231,7 +963,7 @@ def login():
         password = request.form['password']
         remember_me = 'remember_me' in request.form
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT id, username, role, approved, banned, unique_id FROM users WHERE username = ? AND password = ?", 
                  (username, password))
@@ -239,14 +971,12 @@ def login():
         
         if user:
             if not user[3]:  # approved column
-                conn.close()
                 return render_template('login.html', error="Account pending admin approval. Please wait.")
             
             if user[4]:  # banned column
                 c.execute("SELECT ban_reason FROM users WHERE id = ?", (user[0],))
                 ban_details = c.fetchone()
                 ban_reason = ban_details[0] if ban_details else "No reason provided"
-                conn.close()
                 return render_template('login.html', error=f"Account banned. Reason: {ban_reason}")
             
             session['username'] = user[1]
@@ -257,7 +987,7 @@ def login():
             if remember_me:
                 session.permanent = True
             
-            c.execute("UPDATE users SET last_login = ?, is_online = TRUE WHERE id = ?", 
+            c.execute("UPDATE users SET last_login = ? WHERE id = ?", 
                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user[0]))
             conn.commit()
             
@@ -266,12 +996,9 @@ def login():
                 c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user[0],))
                 conn.commit()
             
-            conn.close()
-            
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('chat'))
         
-        conn.close()
         return render_template('login.html', error="Invalid credentials")
     
     return render_template('login.html')
@@ -295,7 +1022,7 @@ def register():
         if len(password) < 6:
             return render_template('register.html', error="Password must be at least 6 characters")
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         try:
             # Generate unique_id
@@ -311,12 +1038,9 @@ def register():
             c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
             conn.commit()
             
-            conn.close()
-            
             flash('Registration successful! Please wait for admin approval.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
-            conn.close()
             return render_template('register.html', error="Username, email, or ID already exists")
     
     return render_template('register.html')
@@ -325,7 +1049,7 @@ def register():
 def forgot_password():
     if request.method == 'POST':
         unique_id = request.form['unique_id']
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE unique_id = ?", (unique_id,))
         user = c.fetchone()
@@ -334,7 +1058,6 @@ def forgot_password():
             return render_template('forgot_password.html', 
                                  success=f"Valid ID. Proceed to reset your password using your ID: {unique_id}")
         
-        conn.close()
         return render_template('forgot_password.html', error="Invalid ID")
     
     return render_template('forgot_password.html')
@@ -351,12 +1074,11 @@ def update_password():
             if new_password != confirm_password:
                 return render_template('update_password.html', error="Passwords do not match")
             
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute("UPDATE users SET password = ? WHERE username = ?", 
                      (new_password, username))
             conn.commit()
-            conn.close()
             return render_template('update_password.html', success="Password updated successfully")
         else:
             # Password reset via unique_id
@@ -367,7 +1089,7 @@ def update_password():
             if new_password != confirm_password:
                 return render_template('update_password.html', error="Passwords do not match")
             
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute("SELECT * FROM users WHERE unique_id = ?", (unique_id,))
             user = c.fetchone()
@@ -376,10 +1098,8 @@ def update_password():
                 c.execute("UPDATE users SET password = ? WHERE unique_id = ?", 
                          (new_password, unique_id))
                 conn.commit()
-                conn.close()
                 return render_template('update_password.html', success="Password reset successfully. Please login.")
             
-            conn.close()
             return render_template('update_password.html', error="Invalid ID")
     
     return render_template('update_password.html')
@@ -388,31 +1108,23 @@ def update_password():
 @login_required
 @approval_required
 def chat():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Get all rooms
-    c.execute("SELECT name, description, allowed_roles FROM rooms WHERE is_active = TRUE")
-    all_rooms = c.fetchall()
-    
-    # Filter rooms based on user role
-    available_rooms = []
-    for room in all_rooms:
-        allowed_roles = json.loads(room[2])
-        if session['role'] == 'admin' or session['role'] in allowed_roles:
-            available_rooms.append({
-                'name': room[0], 
-                'description': room[1],
-                'allowed_roles': allowed_roles
-            })
+    # Rooms available to the user's role
+    available_rooms = [
+        {
+            'name': room.name,
+            'description': room.description,
+            'allowed_roles': sorted(room.allowed_roles)
+        } for room in room_registry.visible_rooms(session['role'])
+    ]
     
     # Get user settings
     c.execute("SELECT theme, notifications, sound_effects, font_size, auto_login FROM user_settings WHERE user_id = ?", 
              (session['user_id'],))
     settings_row = c.fetchone()
     
-    conn.close()
-    
     settings = {}
     if settings_row:
         settings = {
@@ -427,18 +1139,59 @@ def chat():
                          username=session['username'], 
                          role=session['role'],
                          rooms=available_rooms,
-                         settings=settings)
+                         settings=settings,
+                         live_stream=app.config['LIVE_STREAM'])
 
 @app.route('/get_online_users')
 @login_required
 @approval_required
 def get_online_users():
-    conn = sqlite3.connect('chatdatabase.db')
-    c = conn.cursor()
-    c.execute("SELECT username, role FROM users WHERE is_online = TRUE AND username != ?", (session['username'],))
-    online_users = [{'username': row[0], 'role': row[1]} for row in c.fetchall()]
-    conn.close()
-    return jsonify(online_users)
+    room = request.args.get('room') or None
+    if room and not room_registry.can_access(session['role'], room):
+        return jsonify({'error': 'Access denied to this room'}), 403
+    
+    # With ?since=<version> only the joins and leaves since then are sent, or
+    # 304 when nothing changed; a version this worker cannot answer from its
+    # change log gets the full list
+    since = request.args.get('since')
+    etag = json_etag('online', presence.version(), room, since, session['username'])
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    delta = presence.changes_since(since, room) if since else None
+    if delta is not None:
+        version, joins, leaves = delta
+        joins = [user for user in joins if user['username'] != session['username']]
+        leaves = [username for username in leaves if username != session['username']]
+        if not joins and not leaves:
+            return with_etag(app.response_class(status=304), etag)
+        return with_etag(jsonify({'version': version, 'joins': joins, 'leaves': leaves}), etag)
+    
+    version, users = presence.snapshot(room)
+    online_users = [user for user in users if user['username'] != session['username']]
+    return with_etag(jsonify({'version': version, 'users': online_users}), etag)
+
+# Keeps the user online (and in room, if given) for another PRESENCE_TTL seconds
+@app.route('/heartbeat', methods=['POST'])
+@login_required
+@approval_required
+def heartbeat():
+    data = request.get_json(silent=True) or {}
+    room = data.get('room')
+    if room and not room_registry.can_access(session['role'], room):
+        return jsonify({'error': 'Access denied to this room'}), 403
+    now = time.time()
+    event_bus.publish('presence', {
+        'op': 'beat',
+        'user_id': session['user_id'],
+        'username': session['username'],
+        'role': session['role'],
+        'room': room or None,
+        'time': now
+    })
+    presence.note_seen(session['user_id'], now)
+    return jsonify({'status': 'success', 'interval': app.config['PRESENCE_HEARTBEAT_SECONDS']})
 
 @app.route('/send_message', methods=['POST'])
 @login_required
@@ -462,195 +1215,412 @@ def send_message():
             print("Error: Text message is empty")
             return jsonify({'status': 'error', 'error': 'Text message cannot be empty'}), 400
         
-        conn = sqlite3.connect('chatdatabase.db')
-        c = conn.cursor()
-        c.execute("SELECT allowed_roles FROM rooms WHERE name = ?", (room,))
-        room_data = c.fetchone()
-        
-        if not room_data:
-            conn.close()
+        if room_registry.get(room) is None:
             print("Room not found")
             return jsonify({'status': 'error', 'error': 'Room not found'}), 404
         
-        allowed_roles = json.loads(room_data[0])
-        if session['role'] != 'admin' and session['role'] not in allowed_roles:
-            conn.close()
+        if not room_registry.can_access(session['role'], room):
             print(f"Access denied: User role {session['role']} not allowed in room {room}")
             return jsonify({'status': 'error', 'error': 'Access denied to this room'}), 403
         
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         file_path = None
-        
-        if 'file' in request.files:
-            file = request.files['file']
-            print(f"File received: filename={file.filename}, content_type={file.content_type}")
-            if file and file.filename and allowed_file(file.filename):
-                if 'UPLOAD_FOLDER' not in app.config:
-                    conn.close()
-                    print("Error: UPLOAD_FOLDER not configured")
-                    return jsonify({'status': 'error', 'error': 'Server configuration error: Upload folder not set'}), 500
-                
-                filename = secure_filename(file.filename)
-                unique_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        file_name = None
+        blob = None
+        
+        # The file is already on disk (streamed there while the form was
+        # parsed); it is moved into place in the write transaction below
+        upload_id = request.form.get('upload_id')
+        if 'file' in request.files or upload_id:
+            if upload_id:
+                try:
+                    filename = resumable_uploads.filename(upload_id, session['user_id'])
+                except UploadError as e:
+                    return jsonify({'status': 'error', 'error': str(e)}), e.status
+            else:
+                file = request.files['file']
+                filename = file.filename
+                print(f"File received: filename={file.filename}, content_type={file.content_type}")
+            
+            if filename and allowed_file(filename):
+                file_name = secure_filename(filename)
+                ext = file_name.rsplit('.', 1)[1].lower() if '.' in file_name else ''
                 
                 try:
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    file.save(file_path)
-                    file_path = f"static/uploads/{unique_filename}"
-                    print(f"File saved: {file_path}")
+                    # Stored under its content hash, so a re-sent file is not written twice
+                    if upload_id:
+                        blob = resumable_uploads.finish(upload_id, session['user_id'], app.config['UPLOAD_FOLDER'], ext)
+                    else:
+                        blob = store_upload(file, app.config['UPLOAD_FOLDER'], ext)
+                    file_path = f"static/uploads/{os.path.basename(blob.path)}"
+                    print(f"File received: {file_path} ({blob.size} bytes)")
+                except UploadError as e:
+                    return jsonify({'status': 'error', 'error': str(e)}), e.status
                 except Exception as e:
-                    conn.close()
                     print(f"Error saving file: {str(e)}")
                     return jsonify({'status': 'error', 'error': 'Failed to save file'}), 500
             else:
-                conn.close()
                 print(f"Error: Invalid file or extension")
                 return jsonify({'status': 'error', 'error': f"Invalid file. Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
         
         if not message and not file_path and message_type != 'document':
-            conn.close()
             print("Error: No message content or file provided")
             return jsonify({'status': 'error', 'error': 'Message or file required'}), 400
         
-        reply_username = None
-        reply_preview = None
-        if reply_to:
-            try:
-                reply_to = int(reply_to)
-                c.execute("""
-                    SELECT username, message, message_type, file_path 
-                    FROM messages 
-                    WHERE id = ? AND room = ?
-                """, (reply_to, room))
-                reply_data = c.fetchone()
-                if reply_data:
-                    reply_username = reply_data[0]
-                    reply_message = reply_data[1]
-                    reply_message_type = reply_data[2]
-                    reply_file_path = reply_data[3]
-                    if reply_message_type in ['image', 'video', 'audio', 'document']:
-                        reply_preview = f"[{reply_message_type.capitalize()} message]"
-                    else:
-                        reply_preview = reply_message[:50] + ('...' if len(reply_message) > 50 else '')
-                else:
-                    reply_to = None
-            except (ValueError, TypeError):
-                reply_to = None
-        
-        c.execute("""
-            INSERT INTO messages (room, username, message, message_type, file_path, timestamp, reply_to) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (room, session['username'], message, message_type, file_path, timestamp, reply_to))
+        try:
+            reply_to = int(reply_to) if reply_to else None
+        except (ValueError, TypeError):
+            reply_to = None
         
-        message_id = c.lastrowid
-        conn.commit()
+        # Reply lookup and insert share one short write transaction, so the
+        # reply target cannot be deleted in between; the response is built
+        # from the values already at hand rather than read back afterwards
+        username = session['username']
         
-        c.execute("""
-            SELECT id, room, username, message, message_type, file_path, timestamp, is_edited, edited_at, reply_to
-            FROM messages 
-            WHERE id = ?
-        """, (message_id,))
+        def write(c):
+            return insert_message(c, room, username, message, message_type, timestamp,
+                                  reply_to, file_path, file_name, blob)
         
-        message_row = c.fetchone()
-        conn.close()
-        
-        if not message_row:
-            print("Error: Failed to retrieve inserted message")
-            return jsonify({'status': 'error', 'error': 'Failed to send message'}), 500
+        if app.config['GROUP_COMMIT']:
+            message_id, reply_to, reply_username, reply_preview, thumbnail_path = group_writer.submit(write)
+        else:
+            conn = get_db()
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            message_id, reply_to, reply_username, reply_preview, thumbnail_path = write(c)
+            conn.commit()
+        discard_temp(blob)
         
         message_data = {
             'status': 'success',
-            'id': message_row[0],
-            'room': message_row[1],
-            'username': message_row[2],
-            'message': message_row[3],
-            'message_type': message_row[4],
-            'file_path': message_row[5],
-            'timestamp': message_row[6],
-            'is_edited': bool(message_row[7]),
-            'edited_at': message_row[8],
-            'reply_to': message_row[9],
+            'id': message_id,
+            'room': room,
+            'username': session['username'],
+            'message': message,
+            'message_type': message_type,
+            'file_path': file_path,
+            'timestamp': timestamp,
+            'is_edited': False,
+            'edited_at': None,
+            'reply_to': reply_to,
+            'file_name': file_name,
+            'thumbnail_path': thumbnail_path,
             'reply_username': reply_username,
             'reply_preview': reply_preview
         }
         
+        publish_room_event(room, 'message', {k: v for k, v in message_data.items() if k != 'status'})
+        
+        if blob is not None and not message_data['thumbnail_path']:
+            queue_preview(file_path, get_file_type(file_name))
+        
         print("Message inserted successfully")
         return jsonify(message_data)
         
     except sqlite3.Error as e:
         print(f"Database error in send_message: {str(e)}")
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
+        remove_orphaned_upload(locals().get('blob'), locals().get('file_path'))
         return jsonify({'status': 'error', 'error': 'Database error occurred'}), 500
     except Exception as e:
         print(f"Error in send_message: {str(e)}")
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
+        remove_orphaned_upload(locals().get('blob'), locals().get('file_path'))
         return jsonify({'status': 'error', 'error': f'Server error: {str(e)}'}), 500
 
+# Many text messages (to one or several rooms) in a single transaction, for
+# imports, announcements and clients replaying what they queued offline.
+# The whole batch is validated first and written all-or-nothing.
+@app.route('/send_messages', methods=['POST'])
+@login_required
+@approval_required
+def send_messages():
+    data = request.get_json(silent=True) or {}
+    items = data.get('messages')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'error': 'messages must be a non-empty list'}), 400
+    if len(items) > app.config['BATCH_MAX_MESSAGES']:
+        return jsonify({'status': 'error', 'error': f"At most {app.config['BATCH_MAX_MESSAGES']} messages per batch"}), 400
+    
+    errors = []
+    allowed = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'error': 'Message must be an object'})
+            continue
+        room = item.get('room')
+        message = str(item.get('message') or '').strip()
+        if not isinstance(room, str):
+            errors.append({'index': index, 'error': 'Room parameter is required'})
+            continue
+        if room not in allowed:
+            allowed[room] = room_registry.can_access(session['role'], room)
+        if not allowed[room]:
+            errors.append({'index': index, 'error': 'Room not found or access denied'})
+        elif not message:
+            errors.append({'index': index, 'error': 'Text message cannot be empty'})
+        elif item.get('message_type', 'text') != 'text':
+            errors.append({'index': index, 'error': 'Only text messages can be sent in a batch'})
+    if errors:
+        return jsonify({'status': 'error', 'error': 'Invalid messages in batch', 'errors': errors}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        # Reply targets for the whole batch in one query; a reply only counts within its room
+        reply_ids = set()
+        for item in items:
+            try:
+                reply_ids.add(int(item['reply_to']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        replies = {}
+        if reply_ids:
+            c.execute(f"SELECT id, room, username, message, message_type FROM messages WHERE id IN ({', '.join('?' * len(reply_ids))})",
+                      list(reply_ids))
+            replies = {row[0]: row[1:] for row in c.fetchall()}
+        
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        messages = []
+        for item in items:
+            room = item['room']
+            message = str(item['message']).strip()
+            reply = None
+            try:
+                reply_to = int(item.get('reply_to'))
+                reply = replies.get(reply_to)
+            except (TypeError, ValueError):
+                reply_to = None
+            if reply is None or reply[0] != room:
+                reply_to, reply = None, None
+            
+            rows.append((room, session['username'], message, 'text', None, timestamp, reply_to))
+            message_data = {
+                'room': room,
+                'username': session['username'],
+                'message': message,
+                'message_type': 'text',
+                'file_path': None,
+                'file_name': None,
+                'thumbnail_path': None,
+                'timestamp': timestamp,
+                'is_edited': False,
+                'edited_at': None,
+                'reply_to': reply_to
+            }
+            if reply is not None:
+                message_data['reply_username'] = reply[1]
+                message_data['reply_preview'] = make_reply_preview(reply[2], reply[3])
+            messages.append(message_data)
+        
+        c.executemany("""
+            INSERT INTO messages (room, username, message, message_type, file_path, timestamp, reply_to)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        # The transaction holds the write lock for the whole executemany, so
+        # the AUTOINCREMENT ids it assigned are consecutive, ending here
+        c.execute("SELECT last_insert_rowid()")
+        first_id = c.fetchone()[0] - len(rows) + 1
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error in send_messages: {str(e)}")
+        conn.rollback()
+        return jsonify({'status': 'error', 'error': 'Database error occurred'}), 500
+    
+    for offset, message_data in enumerate(messages):
+        message_data['id'] = first_id + offset
+        publish_room_event(message_data['room'], 'message', message_data)
+    
+    return jsonify({'status': 'success', 'ids': [m['id'] for m in messages]})
+
 @app.route('/get_messages/<room>')
 @login_required
 @approval_required
 def get_messages(room):
-    conn = sqlite3.connect('chatdatabase.db')
+    if room_registry.get(room) is None:
+        return jsonify({'error': 'Room not found'}), 404
+    
+    if not room_registry.can_access(session['role'], room):
+        return jsonify({'error': 'Access denied to this room'}), 403
+    
+    # At least one message; a negative limit no longer means "no limit"
+    limit = max(1, min(request.args.get('limit', 850, type=int), 5000))
+    offset = request.args.get('offset', type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    
+    # The tag comes from the room version as read from the database, never
+    # from what the recent-message buffer holds, so a list is only revalidated
+    # once every message up to that version is in it. The 304 carries no
+    # X-Last-Change-Id, so the client keeps the one that came with its copy.
+    version = get_room_version(room)
+    etag = json_etag('messages', room, version, limit, offset, before_id, after_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    if offset is None:
+        messages = read_recent_messages(room, version, limit, before_id, after_id)
+        if messages is not None:
+            # Changes up to the room version are already applied to the buffer
+            response = messages_response(messages)
+            response.headers['X-Last-Change-Id'] = str(version[1])
+            return with_etag(response, etag)
+    
+    conn = get_db()
     c = conn.cursor()
     
-    c.execute("SELECT allowed_roles FROM rooms WHERE name = ?", (room,))
-    room_data = c.fetchone()
+    # Read before the messages: a change committed in between is then replayed
+    # by the next poll instead of being skipped
+    last_change_id = get_last_change_id(c, room)
     
-    if not room_data:
-        conn.close()
+    if after_id is not None:
+        # Live tailing: everything newer than the last message the client has
+        c.execute(MESSAGE_SELECT + """
+            WHERE m.room = ? AND m.id > ? 
+            ORDER BY m.id ASC 
+            LIMIT ?
+        """, (room, after_id, limit))
+        rows = c.fetchall()
+    elif offset is not None:
+        # Legacy offset paging, kept for older clients
+        c.execute(MESSAGE_SELECT + """
+            WHERE m.room = ? 
+            ORDER BY m.timestamp DESC 
+            LIMIT ? OFFSET ?
+        """, (room, limit, offset))
+        rows = c.fetchall()[::-1]
+    else:
+        # Keyset paging over idx_messages_room_id; before_id walks back through history
+        c.execute(MESSAGE_SELECT + """
+            WHERE m.room = ? AND m.id < ? 
+            ORDER BY m.id DESC 
+            LIMIT ?
+        """, (room, before_id if before_id is not None else sys.maxsize, limit))
+        rows = c.fetchall()[::-1]
+    
+    messages = [message_from_row(row) for row in rows]
+    
+    # Lets the client start incremental polling from exactly this snapshot
+    response = messages_response(messages)
+    response.headers['X-Last-Change-Id'] = str(last_change_id)
+    return with_etag(response, etag)
+
+@app.route('/get_updates/<room>')
+@login_required
+@approval_required
+def get_updates(room):
+    after_id = request.args.get('after_id', type=int)
+    change_id = request.args.get('change_id', type=int)
+    limit = max(1, min(request.args.get('limit', 200, type=int), 5000))
+    
+    if after_id is None:
+        return jsonify({'error': 'after_id parameter required'}), 400
+    
+    if room_registry.get(room) is None:
         return jsonify({'error': 'Room not found'}), 404
     
-    allowed_roles = json.loads(room_data[0])
-    if session['role'] != 'admin' and session['role'] not in allowed_roles:
-        conn.close()
+    if not room_registry.can_access(session['role'], room):
         return jsonify({'error': 'Access denied to this room'}), 403
     
-    limit = request.args.get('limit', 850)
-    offset = request.args.get('offset', 0)
+    etag = json_etag('updates', room, get_room_version(room), after_id, change_id, limit)
+    cached = not_modified(etag)
+    if cached:
+        return cached
     
-    c.execute("""
-        SELECT id, username, message, message_type, file_path, timestamp, is_edited, edited_at, reply_to
-        FROM messages 
-        WHERE room = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ? OFFSET ?
-    """, (room, limit, offset))
-    
-    messages = []
-    for row in c.fetchall():
-        message = {
-            'id': row[0],
-            'username': row[1],
-            'message': row[2],
-            'message_type': row[3],
-            'file_path': row[4],
-            'timestamp': row[5],
-            'is_edited': bool(row[6]),
-            'edited_at': row[7],
-            'reply_to': row[8]
-        }
-        if message['reply_to']:
-            c.execute("""
-                SELECT username, message, message_type, file_path 
-                FROM messages 
-                WHERE id = ?
-            """, (message['reply_to'],))
-            reply_data = c.fetchone()
-            if reply_data:
-                message['reply_username'] = reply_data[0]
-                reply_message = reply_data[1]
-                reply_message_type = reply_data[2]
-                if reply_message_type in ['image', 'video', 'audio', 'document']:
-                    message['reply_preview'] = f"[{reply_message_type.capitalize()} message]"
-                else:
-                    message['reply_preview'] = reply_message[:50] + ('...' if len(reply_message) > 50 else '')
-        messages.append(message)
-    
-    conn.close()
-    return jsonify(messages[::-1])
+    conn = get_db()
+    c = conn.cursor()
+    
+    if change_id is None:
+        # First poll: nothing to replay, just hand back the current position
+        change_id = get_last_change_id(c, room)
+    messages, changes, has_more = fetch_room_updates(c, room, after_id, change_id, limit)
+    last_change_id = changes[-1]['change_id'] if changes else change_id
+    
+    return with_etag(jsonify({
+        'messages': messages,
+        'changes': changes,
+        'last_id': messages[-1]['id'] if messages else after_id,
+        'last_change_id': last_change_id,
+        'has_more': has_more
+    }), etag)
+
+# Opens a room stream for the current request: checks access, works out
+# where the client is, subscribes and reads the backlog. Returns a RoomStream,
+# or an error response. Also used by the asyncio server in asgi.py.
+@login_required
+@approval_required
+def open_room_stream(room, subscribe=None):
+    conn = get_db()
+    c = conn.cursor()
+    
+    if room_registry.get(room) is None:
+        return jsonify({'error': 'Room not found'}), 404
+    
+    if not room_registry.can_access(session['role'], room):
+        return jsonify({'error': 'Access denied to this room'}), 403
+    
+    # A reconnecting EventSource sends Last-Event-ID; a fresh one passes the
+    # cursors from its initial get_messages load
+    cursor = parse_event_id(request.headers.get('Last-Event-ID'))
+    if cursor:
+        after_id, change_id = cursor
+    else:
+        after_id = request.args.get('after_id', type=int)
+        change_id = request.args.get('change_id', type=int)
+        if after_id is None:
+            after_id = get_last_message_id(c, room)
+        if change_id is None:
+            change_id = get_last_change_id(c, room)
+    
+    # Subscribe before reading the backlog so nothing committed in between is lost
+    sub = (subscribe or event_hub.subscribe)(room, session['user_id'])
+    try:
+        messages, changes, has_more = fetch_room_updates(c, room, after_id, change_id,
+                                                         app.config['STREAM_REPLAY_LIMIT'])
+    except Exception:
+        sub.close()
+        raise
+    
+    return RoomStream(sub, after_id, change_id, messages, changes, has_more, app.config['STREAM_RETRY_MS'])
+
+@app.route('/stream/<room>')
+def stream(room):
+    room_stream = open_room_stream(room)
+    if not isinstance(room_stream, RoomStream):
+        return room_stream
+    
+    max_seconds = app.config['STREAM_MAX_SECONDS']
+    keepalive = app.config['STREAM_KEEPALIVE_SECONDS']
+    
+    def generate():
+        try:
+            yield from room_stream.backlog()
+            if room_stream.has_more:
+                return
+            
+            deadline = time.monotonic() + max_seconds
+            while not room_stream.sub.overflowed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = room_stream.sub.queue.get(timeout=min(keepalive, remaining))
+                except Empty:
+                    yield SSE_KEEPALIVE
+                    continue
+                if event is None:
+                    break
+                text = room_stream.render(event)
+                if text:
+                    yield text
+        finally:
+            room_stream.close()
+    
+    return app.response_class(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 @app.route('/search_messages')
 @login_required
@@ -662,44 +1632,49 @@ def search_messages():
     if not query:
         return jsonify({'error': 'Query parameter required'}), 400
     
-    conn = sqlite3.connect('chatdatabase.db')
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, username, message, message_type, timestamp, reply_to
-        FROM messages 
-        WHERE room = ? AND message LIKE ? 
-        ORDER BY timestamp DESC
-    """, (room, f'%{query}%'))
-    
-    results = []
-    for row in c.fetchall():
-        message = {
-            'id': row[0],
-            'username': row[1],
-            'message': row[2],
-            'message_type': row[3],
-            'timestamp': row[4],
-            'reply_to': row[5]
-        }
-        if message['reply_to']:
-            c.execute("""
-                SELECT username, message, message_type 
-                FROM messages 
-                WHERE id = ?
-            """, (message['reply_to'],))
-            reply_data = c.fetchone()
-            if reply_data:
-                message['reply_username'] = reply_data[0]
-                reply_message = reply_data[1]
-                reply_message_type = reply_data[2]
-                if reply_message_type in ['image', 'video', 'audio', 'document']:
-                    message['reply_preview'] = f"[{reply_message_type.capitalize()} message]"
-                else:
-                    message['reply_preview'] = reply_message[:50] + ('...' if len(reply_message) > 50 else '')
-        results.append(message)
-    
-    conn.close()
-    return jsonify(results)
+    # Without a room (or with scope=all) every room the caller's role can read is searched at once
+    cross_room = request.args.get('scope') == 'all' or not room
+    if cross_room:
+        rooms = room_registry.accessible_names(session['role'])
+    else:
+        if room_registry.get(room) is None:
+            return jsonify({'error': 'Room not found'}), 404
+        
+        if not room_registry.can_access(session['role'], room):
+            return jsonify({'error': 'Access denied to this room'}), 403
+        rooms = [room]
+    
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    sort = request.args.get('sort', 'rank')
+    cursor = request.args.get('cursor')
+    
+    etag = json_etag('search', [(name, get_room_version(name)) for name in rooms],
+                     query, cross_room, limit, sort, cursor)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    c = get_db().cursor()
+    try:
+        if fts_enabled:
+            results, next_cursor = search_fts(c, rooms, query, sort, cursor, limit)
+        else:
+            results, next_cursor = search_like(c, rooms, query, cursor, limit)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    if cross_room:
+        # Per-room counts only come with the first page
+        return with_etag(jsonify({
+            'results': results,
+            'room_counts': count_search_hits(c, rooms, query) if not cursor else None,
+            'next_cursor': next_cursor
+        }), etag)
+    
+    response = jsonify(results)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return with_etag(response, etag)
 
 @app.route('/user_settings', methods=['GET', 'POST'])
 @login_required
@@ -712,7 +1687,7 @@ def user_settings():
         font_size = request.form.get('font_size')
         auto_login = 'auto_login' in request.form
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("""
             UPDATE user_settings 
@@ -720,17 +1695,15 @@ def user_settings():
             WHERE user_id = ?
         """, (theme, notifications, sound_effects, font_size, auto_login, session['user_id']))
         conn.commit()
-        conn.close()
         
         flash('Settings saved successfully!')
         return redirect(url_for('user_settings'))
     
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT theme, notifications, sound_effects, font_size, auto_login FROM user_settings WHERE user_id = ?", 
              (session['user_id'],))
     settings_row = c.fetchone()
-    conn.close()
     
     settings = {}
     if settings_row:
@@ -756,7 +1729,7 @@ def edit_message():
         if not message_id or not new_message:
             return jsonify({'error': 'Message ID and new message content are required'}), 400
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         
         c.execute("SELECT room, message_type FROM messages WHERE id = ? AND username = ?", 
@@ -764,23 +1737,15 @@ def edit_message():
         message = c.fetchone()
         
         if not message:
-            conn.close()
             return jsonify({'error': 'Message not found or you do not have permission to edit it'}), 403
         
         if message[1] != 'text':
-            conn.close()
             return jsonify({'error': 'Only text messages can be edited'}), 400
         
-        c.execute("SELECT allowed_roles FROM rooms WHERE name = ?", (message[0],))
-        room_data = c.fetchone()
-        
-        if not room_data:
-            conn.close()
+        if room_registry.get(message[0]) is None:
             return jsonify({'error': 'Room not found'}), 404
         
-        allowed_roles = json.loads(room_data[0])
-        if session['role'] != 'admin' and session['role'] not in allowed_roles:
-            conn.close()
+        if not room_registry.can_access(session['role'], message[0]):
             return jsonify({'error': 'Access denied to this room'}), 403
         
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -791,16 +1756,16 @@ def edit_message():
         """, (new_message, timestamp, message_id, session['username']))
         
         if c.rowcount == 0:
-            conn.close()
             return jsonify({'error': 'Failed to edit message'}), 500
         
+        change = record_message_change(c, message[0], message_id, 'edit', new_message, timestamp)
         conn.commit()
-        conn.close()
+        publish_room_event(message[0], 'edit', change)
         
         return jsonify({'status': 'success'})
     except Exception as e:
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/delete_message', methods=['POST'])
@@ -814,65 +1779,50 @@ def delete_message():
         if not message_id:
             return jsonify({'error': 'Message ID is required'}), 400
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         
         c.execute("SELECT room, username, message_type, file_path FROM messages WHERE id = ?", (message_id,))
         message = c.fetchone()
         
         if not message:
-            conn.close()
             return jsonify({'error': 'Message not found'}), 404
         
         if message[1] != session['username'] and session['role'] != 'admin':
-            conn.close()
             return jsonify({'error': 'You do not have permission to delete this message'}), 403
         
-        c.execute("SELECT allowed_roles FROM rooms WHERE name = ?", (message[0],))
-        room_data = c.fetchone()
-        
-        if not room_data:
-            conn.close()
+        if room_registry.get(message[0]) is None:
             return jsonify({'error': 'Room not found'}), 404
         
-        allowed_roles = json.loads(room_data[0])
-        if session['role'] != 'admin' and session['role'] not in allowed_roles:
-            conn.close()
+        if not room_registry.can_access(session['role'], message[0]):
             return jsonify({'error': 'Access denied to this room'}), 403
         
-        # Delete associated media file if it exists
-        if message[2] in ['image', 'video', 'audio', 'document'] and message[3]:
-            try:
-                file_path = os.path.join('static/uploads', message[3].split('/')[-1])
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                print(f"Error deleting file: {str(e)}")
-                # Continue with message deletion even if file deletion fails
-        
         c.execute("DELETE FROM messages WHERE id = ?", (message_id,))
         
         if c.rowcount == 0:
-            conn.close()
             return jsonify({'error': 'Failed to delete message'}), 500
         
+        # The associated media file goes (in the background) once no other message shares it
+        remove_file = False
+        if message[2] in ['image', 'video', 'audio', 'document'] and message[3]:
+            remove_file = release_upload(c, message[3])
+        
+        change = record_message_change(c, message[0], message_id, 'delete')
         conn.commit()
-        conn.close()
+        publish_room_event(message[0], 'delete', change)
+        if remove_file:
+            job_queue.enqueue('remove_upload', file_path=message[3])
         
         return jsonify({'status': 'success'})
     except Exception as e:
         if 'conn' in locals():
-            conn.close()
+            conn.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/logout')
 def logout():
-    if 'username' in session:
-        conn = sqlite3.connect('chatdatabase.db')
-        c = conn.cursor()
-        c.execute("UPDATE users SET is_online = FALSE WHERE username = ?", (session['username'],))
-        conn.commit()
-        conn.close()
+    if 'user_id' in session:
+        publish_presence_leave(session['user_id'])
     
     session.clear()
     flash('You have been logged out successfully.')
@@ -900,7 +1850,7 @@ def admin_login():
         remember_me = 'remember_me' in request.form
         
         if username in ADMIN_CREDENTIALS and ADMIN_CREDENTIALS[username]['password'] == password:
-            conn = sqlite3.connect('chatdatabase.db')
+            conn = get_db()
             c = conn.cursor()
             
             c.execute("SELECT id, approved, banned, unique_id FROM users WHERE username = ? AND role = 'admin'", (username,))
@@ -909,7 +1859,6 @@ def admin_login():
             if existing_admin:
                 user_id = existing_admin[0]
                 if not existing_admin[1] or existing_admin[2]:
-                    conn.close()
                     return render_template('admin_login.html', error="Admin account is disabled. Please contact system administrator.")
                 unique_id = existing_admin[3]
             else:
@@ -923,7 +1872,6 @@ def admin_login():
                     c.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
                     conn.commit()
                 except sqlite3.IntegrityError:
-                    conn.close()
                     return render_template('admin_login.html', error="Admin account creation failed.")
             
             session['username'] = username
@@ -936,10 +1884,9 @@ def admin_login():
             if remember_me:
                 session.permanent = True
             
-            c.execute("UPDATE users SET last_login = ?, is_online = TRUE WHERE id = ?", 
+            c.execute("UPDATE users SET last_login = ? WHERE id = ?", 
                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
             conn.commit()
-            conn.close()
             
             flash('Admin login successful!')
             return redirect(url_for('admin_users'))
@@ -952,7 +1899,7 @@ def admin_login():
 @login_required
 @role_required(['admin'])
 def admin_users():
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("""
@@ -962,8 +1909,6 @@ def admin_users():
     """)
     users = c.fetchall()
     
-    conn.close()
-    
     user_list = [
         {
             'id': user[0],
@@ -984,12 +1929,12 @@ def admin_users():
 @login_required
 @role_required(['admin'])
 def approve_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("UPDATE users SET approved = TRUE WHERE id = ?", (user_id,))
     conn.commit()
-    conn.close()
+    publish_user_changed(user_id)
     
     flash('User approved successfully!')
     return redirect(url_for('admin_users'))
@@ -998,13 +1943,13 @@ def approve_user(user_id):
 @login_required
 @role_required(['admin'])
 def reject_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    c.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
     conn.commit()
-    conn.close()
+    publish_user_changed(user_id)
+    job_queue.enqueue('purge_user_data', user_id=user_id)
     
     flash('User rejected and removed from system!')
     return redirect(url_for('admin_users'))
@@ -1016,29 +1961,26 @@ def ban_user(user_id):
     if request.method == 'POST':
         ban_reason = request.form.get('ban_reason', 'No reason provided')
         
-        conn = sqlite3.connect('chatdatabase.db')
+        conn = get_db()
         c = conn.cursor()
         
         c.execute("UPDATE users SET banned = TRUE, ban_reason = ?, banned_at = ?, banned_by = ? WHERE id = ?", 
                  (ban_reason, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), session['user_id'], user_id))
         
-        c.execute("UPDATE users SET is_online = FALSE WHERE id = ?", (user_id,))
-        
         conn.commit()
+        publish_user_changed(user_id)
+        publish_presence_leave(user_id)
         
         c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
         username = c.fetchone()[0]
         
-        conn.close()
-        
         flash(f'User {username} has been banned successfully!')
         return redirect(url_for('admin_users'))
     
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         flash('User not found!')
@@ -1046,30 +1988,127 @@ def ban_user(user_id):
     
     return render_template('ban_user.html', user={'id': user_id, 'username': user[0]})
 
+@app.route('/uploads', methods=['POST'])
+@login_required
+@approval_required
+def create_upload():
+    filename = request.form.get('filename', '')
+    size = request.form.get('size', type=int)
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': f"Invalid file. Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    if size is None:
+        return jsonify({'error': 'File size is required'}), 400
+    
+    try:
+        upload_id = resumable_uploads.create(session['user_id'], filename, size)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'size': size,
+                    'max_chunk_size': app.config['MAX_CONTENT_LENGTH']})
+
+# GET reports how much has arrived (to resume), PUT appends the raw request
+# body at ?offset=, DELETE abandons the upload
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@login_required
+@approval_required
+def resumable_upload(upload_id):
+    try:
+        if request.method == 'GET':
+            return jsonify(resumable_uploads.status(upload_id, session['user_id']))
+        if request.method == 'DELETE':
+            resumable_uploads.discard(upload_id, session['user_id'])
+            return jsonify({'status': 'success'})
+        
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'offset parameter required'}), 400
+        return jsonify(resumable_uploads.append(upload_id, session['user_id'], offset, request.stream))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
 @app.route('/static/uploads/<path:filename>')
 def serve_uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    
+    etag = blob_hash(filename)
+    if etag:
+        cache_control = f"public, max-age={app.config['UPLOAD_CACHE_MAX_AGE']}, immutable"
+    else:
+        stat = os.stat(path)
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        etag = legacy_etag_cache.get(key)
+        if etag is None:
+            etag = hash_file(path)
+            legacy_etag_cache.set(key, etag)
+        cache_control = 'public, no-cache'
+    
+    offload = app.config['UPLOAD_SENDFILE']
+    if offload == 'x-accel-redirect':
+        # The proxy sends the body (and handles Range); only validate here
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] + filename
+        return response.make_conditional(request)
+    
+    # Answers If-None-Match / If-Modified-Since with 304 and Range with 206
+    response = werkzeug_send_file(path, request.environ, etag=etag, conditional=True, max_age=None,
+                                  use_x_sendfile=offload == 'x-sendfile', response_class=app.response_class)
+    response.headers['Cache-Control'] = cache_control
+    # Lets media players seek from the first response
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 @app.route('/admin/unban_user/<int:user_id>')
 @login_required
 @role_required(['admin'])
 def unban_user(user_id):
-    conn = sqlite3.connect('chatdatabase.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("UPDATE users SET banned = FALSE, ban_reason = NULL, banned_at = NULL, banned_by = NULL WHERE id = ?", 
              (user_id,))
     
     conn.commit()
+    publish_user_changed(user_id)
     
     c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
     username = c.fetchone()[0]
     
-    conn.close()
-    
     flash(f'User {username} has been unbanned successfully!')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/db_stats')
+@login_required
+@role_required(['admin'])
+def db_stats():
+    return jsonify({
+        'pool': get_pool().stats(),
+        'settings': pragma_report(get_db()),
+        'user_status_cache': user_status_cache.stats(),
+        'room_version_cache': room_version_cache.stats(),
+        'recent_messages': recent_messages.stats(),
+        'message_fragments': message_fragments.stats(),
+        'group_commit': group_writer.stats() if app.config['GROUP_COMMIT'] else None,
+        'presence': presence.stats()
+    })
+
+@app.route('/admin/jobs')
+@login_required
+@role_required(['admin'])
+def job_status():
+    return jsonify(job_queue.stats(recent=request.args.get('recent', 20, type=int)))
+
+@app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+@role_required(['admin'])
+def retry_job(job_id):
+    if not job_queue.retry(job_id):
+        return jsonify({'error': 'No failed job with that id'}), 404
+    return jsonify({'status': 'success'})
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
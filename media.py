@@ -0,0 +1,82 @@
+import os
+import uuid
+import shutil
+import subprocess
+
+# Pillow and ffmpeg are optional: without them messages are sent as before,
+# just without previews
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+FFMPEG = shutil.which('ffmpeg')
+
+
+# The file cannot be previewed (not a readable image or video), so trying
+# again will not help
+class PreviewError(Exception):
+    pass
+
+
+def preview_supported(kind):
+    if kind == 'image':
+        return Image is not None
+    if kind == 'video':
+        return FFMPEG is not None
+    return False
+
+
+# Previews are derived from content-addressed files, so they are named after
+# the same hash
+def preview_name(sha256):
+    return f"{sha256}.thumb.jpg"
+
+
+def make_image_thumbnail(source, dest, max_size):
+    try:
+        img = Image.open(source)
+        img.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise PreviewError(f"cannot read image: {e}")
+    with img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(dest, 'JPEG', quality=80, optimize=True)
+
+
+# First frame after one second (or the very first, for shorter clips)
+def make_video_poster(source, dest, max_size):
+    for offset in ('1', '0'):
+        try:
+            subprocess.run([
+                FFMPEG, '-v', 'error', '-y', '-ss', offset, '-i', source,
+                '-frames:v', '1', '-vf', f"scale={max_size}:{max_size}:force_original_aspect_ratio=decrease",
+                '-f', 'mjpeg', dest,
+            ], check=True, timeout=60, stdin=subprocess.DEVNULL)
+        except subprocess.CalledProcessError as e:
+            raise PreviewError(f"ffmpeg cannot read video (exit status {e.returncode})")
+        if os.path.getsize(dest) > 0:
+            return
+    raise PreviewError("no video frame found")
+
+
+# Writes the preview for source to dest (atomically, so a half-written file is
+# never served). Returns False when the tool for this kind is not installed,
+# and raises PreviewError when source cannot be previewed.
+def create_preview(kind, source, dest, max_size):
+    if not preview_supported(kind):
+        return False
+    temp = f"{dest}.{uuid.uuid4().hex}.tmp"
+    try:
+        if kind == 'image':
+            make_image_thumbnail(source, temp, max_size)
+        else:
+            make_video_poster(source, temp, max_size)
+        os.replace(temp, dest)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
+    return True
@@ -0,0 +1,186 @@
+import time
+import uuid
+import threading
+import logging
+from collections import deque
+
+from background import PerProcess
+
+logger = logging.getLogger(__name__)
+
+
+# Who is online, from client heartbeats kept in memory. A user is online while
+# their latest heartbeat is younger than ttl seconds, and in a room while their
+# latest heartbeat from that room is. Every state change is returned as a
+# change dict ({'op': 'join' | 'leave', 'username', 'role', 'room'}, with room
+# None for the global list) so callers can push deltas instead of full lists.
+#
+# Heartbeats are applied in every worker (through the event bus), so each
+# worker holds the same view; last-seen times are recorded only by the worker
+# that received the heartbeat and written to the database in batches.
+#
+# Each change also bumps a version and goes into a bounded change log, so a
+# client that saw version v can be sent just what changed since (see
+# changes_since). Versions are local to a worker; the token carries a
+# per-worker epoch so a token from another worker is never misread.
+class PresenceTracker:
+    def __init__(self, ttl=45.0, log_size=1000):
+        self.ttl = ttl
+        self._users = {}
+        self._log = deque(maxlen=log_size)
+        self._version = 0
+        self._epoch = uuid.uuid4().hex[:8]
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._process = PerProcess()
+
+    def beat(self, user_id, username, role, room=None, now=None):
+        now = time.time() if now is None else now
+        changes = []
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry['expires'] <= now:
+                if entry is not None:
+                    changes.extend(self._leave_all(entry))
+                entry = {'username': username, 'role': role, 'expires': 0, 'rooms': {}}
+                self._users[user_id] = entry
+                changes.append(self._change('join', entry))
+            entry['expires'] = now + self.ttl
+            if room:
+                if entry['rooms'].get(room, 0) <= now:
+                    changes.append(self._change('join', entry, room))
+                entry['rooms'][room] = now + self.ttl
+        return changes
+
+    def leave(self, user_id):
+        with self._lock:
+            entry = self._users.pop(user_id, None)
+            return self._leave_all(entry) if entry else []
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        changes = []
+        with self._lock:
+            for user_id, entry in list(self._users.items()):
+                if entry['expires'] <= now:
+                    del self._users[user_id]
+                    changes.extend(self._leave_all(entry))
+                    continue
+                for room, expires in list(entry['rooms'].items()):
+                    if expires <= now:
+                        del entry['rooms'][room]
+                        changes.append(self._change('leave', entry, room))
+        return changes
+
+    # Rooms still listed in an entry have not had their leave reported yet
+    def _leave_all(self, entry):
+        changes = [self._change('leave', entry, room) for room in entry['rooms']]
+        changes.append(self._change('leave', entry))
+        return changes
+
+    # Called with the lock held
+    def _change(self, op, entry, room=None):
+        change = {'op': op, 'username': entry['username'], 'role': entry['role'], 'room': room}
+        self._version += 1
+        self._log.append((self._version, change))
+        return change
+
+    def _token(self):
+        return f"{self._epoch}.{self._version}"
+
+    # Users who have not been swept out yet; the sweep runs every ttl / 10
+    # seconds, which keeps this list and the change log in step
+    def _online(self, room):
+        users = [{'username': entry['username'], 'role': entry['role']}
+                 for entry in self._users.values() if room is None or room in entry['rooms']]
+        return sorted(users, key=lambda user: user['username'])
+
+    def online(self, room=None):
+        with self._lock:
+            return self._online(room)
+
+    # Current version token, which changes with every join and leave
+    def version(self):
+        with self._lock:
+            return self._token()
+
+    def snapshot(self, room=None):
+        with self._lock:
+            return self._token(), self._online(room)
+
+    # (token, joins, leaves) with the net changes to the global list (or a
+    # room's) since the version in token: joins as {'username', 'role'},
+    # leaves as usernames. None when that version is not in the log (another
+    # worker's token, or one too old), in which case send a snapshot instead.
+    def changes_since(self, token, room=None):
+        epoch, _, version = (token or '').partition('.')
+        with self._lock:
+            if epoch != self._epoch or not version.isdigit():
+                return None
+            version = int(version)
+            first = self._log[0][0] if self._log else self._version + 1
+            if not first - 1 <= version <= self._version:
+                return None
+            first, latest = {}, {}
+            for change_version, change in self._log:
+                if change_version > version and change['room'] == room:
+                    first.setdefault(change['username'], change)
+                    latest[change['username']] = change
+            token = self._token()
+        # Someone who both joined and left in between was never seen by the client
+        joins = [{'username': c['username'], 'role': c['role']} for c in latest.values() if c['op'] == 'join']
+        leaves = [username for username, c in latest.items()
+                  if c['op'] == 'leave' and first[username]['op'] == 'leave']
+        return token, joins, leaves
+
+    def note_seen(self, user_id, now=None):
+        with self._lock:
+            self._last_seen[user_id] = time.time() if now is None else now
+
+    # {user_id: last heartbeat time} recorded since the previous call
+    def take_last_seen(self):
+        with self._lock:
+            last_seen, self._last_seen = self._last_seen, {}
+        return last_seen
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'online': sum(1 for entry in self._users.values() if entry['expires'] > now),
+                'tracked': len(self._users),
+                'version': self._token(),
+                'log_size': len(self._log),
+                'pending_last_seen': len(self._last_seen),
+                'ttl': self.ttl,
+            }
+
+    # Background sweep: expires users every few seconds, passing the changes
+    # to on_changes, and hands batched last-seen times to on_flush
+    def start(self, on_changes, on_flush, flush_interval=30.0):
+        self._process.run(lambda: self._start(on_changes, on_flush, flush_interval))
+
+    def _start(self, on_changes, on_flush, flush_interval):
+        # A forked worker's versions must not be mistaken for its parent's
+        with self._lock:
+            self._epoch = uuid.uuid4().hex[:8]
+            self._last_seen = {}
+        threading.Thread(target=self._sweep, args=(on_changes, on_flush, flush_interval),
+                         name='presence', daemon=True).start()
+
+    def _sweep(self, on_changes, on_flush, flush_interval):
+        interval = max(1.0, self.ttl / 10)
+        next_flush = time.monotonic() + flush_interval
+        while True:
+            time.sleep(interval)
+            try:
+                changes = self.expire()
+                if changes:
+                    on_changes(changes)
+                if time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + flush_interval
+                    last_seen = self.take_last_seen()
+                    if last_seen:
+                        on_flush(last_seen)
+            except Exception:
+                logger.exception("Presence sweep failed")
@@ -0,0 +1,302 @@
+import os
+import json
+import socket
+import atexit
+import threading
+import asyncio
+import logging
+from queue import Queue, Full
+
+from background import PerProcess
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 256 * 1024
+SEND_TIMEOUT = 0.05
+
+
+# One connected stream listening to a room. Events are queued by the hub and
+# drained by the streaming response; a client that stops reading is cut off
+# once its queue fills, and catches up from the database when it reconnects.
+# A None in the queue tells the response to end the stream.
+class Subscription:
+    def __init__(self, hub, room, max_queue, user_id=None):
+        self.hub = hub
+        self.room = room
+        self.user_id = user_id
+        self.queue = Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.overflowed = True
+            self.hub.unsubscribe(self)
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    # Stops delivery and wakes the response so it ends the stream
+    def end(self):
+        self.hub.unsubscribe(self)
+        self.put(None)
+
+
+# Same as Subscription but drained by a coroutine. Events are published from
+# worker threads, so they are handed to the event loop thread-safely.
+class AsyncSubscription(Subscription):
+    def __init__(self, hub, room, max_queue, loop, user_id=None):
+        self.hub = hub
+        self.room = room
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def put(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.hub.unsubscribe(self)
+
+
+# In-process fan-out of room events (new, edited and deleted messages) to
+# every stream subscribed to that room in this worker.
+class EventHub:
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, room, user_id=None):
+        return self._add(Subscription(self, room, self.max_queue, user_id))
+
+    def subscribe_async(self, room, loop, user_id=None):
+        return self._add(AsyncSubscription(self, room, self.max_queue, loop, user_id))
+
+    def _add(self, sub):
+        with self._lock:
+            self._rooms.setdefault(sub.room, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._rooms.get(sub.room)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._rooms[sub.room]
+
+    def publish(self, room, event):
+        with self._lock:
+            subs = list(self._rooms.get(room, ()))
+        for sub in subs:
+            sub.put(event)
+
+    # To every stream in this worker, whatever its room
+    def broadcast(self, event):
+        with self._lock:
+            subs = [sub for subs in self._rooms.values() for sub in subs]
+        for sub in subs:
+            sub.put(event)
+
+    # Ends every stream the user has open in this worker; the access checks
+    # run again when the browser reconnects
+    def end_user(self, user_id):
+        with self._lock:
+            subs = [sub for subs in self._rooms.values() for sub in subs if sub.user_id == user_id]
+        for sub in subs:
+            sub.end()
+
+    def subscriber_count(self, room=None):
+        with self._lock:
+            if room is not None:
+                return len(self._rooms.get(room, ()))
+            return sum(len(subs) for subs in self._rooms.values())
+
+
+# Event ids carry both cursors (last message id and last change id) so that
+# a reconnect with Last-Event-ID resumes exactly where the stream left off.
+def format_event_id(last_id, last_change_id):
+    return f"{last_id}:{last_change_id}"
+
+
+def parse_event_id(value):
+    try:
+        last_id, last_change_id = value.split(':')
+        return int(last_id), int(last_change_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_sse(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+# State of one open room stream: the backlog read from the database when it
+# was opened, the live subscription, and the cursors sent so far. Shared by
+# the WSGI generator and the asyncio server so both speak the same protocol.
+class RoomStream:
+    def __init__(self, sub, after_id, change_id, messages, changes, has_more, retry_ms):
+        self.sub = sub
+        self.last_id = after_id
+        self.last_change_id = change_id
+        self.messages = messages
+        self.changes = changes
+        self.has_more = has_more
+        self.retry_ms = retry_ms
+        self.replayed_id = after_id
+        self.replayed_change_id = change_id
+
+    # Lines sent when the stream opens; a client too far behind is told to reload instead
+    def backlog(self):
+        yield f"retry: {self.retry_ms}\n\n"
+        if self.has_more:
+            yield format_sse('resync', {})
+            return
+        for message in self.messages:
+            self.last_id = message['id']
+            yield format_sse('message', message, format_event_id(self.last_id, self.last_change_id))
+        for change in self.changes:
+            self.last_change_id = change['change_id']
+            yield format_sse(change['type'], change, format_event_id(self.last_id, self.last_change_id))
+        self.replayed_id, self.replayed_change_id = self.last_id, self.last_change_id
+
+    # SSE text for a live hub event, or None if the backlog already covered it
+    def render(self, event):
+        data = event['data']
+        if event['type'] == 'message':
+            if data['id'] <= self.replayed_id:
+                return None
+            self.last_id = max(self.last_id, data['id'])
+        elif 'change_id' in data:
+            if data['change_id'] <= self.replayed_change_id:
+                return None
+            self.last_change_id = max(self.last_change_id, data['change_id'])
+        return format_sse(event['type'], data, format_event_id(self.last_id, self.last_change_id))
+
+    def close(self):
+        self.sub.close()
+
+
+# Cross-worker broadcast of room events and cache invalidations. Handlers are
+# registered per channel and called with the published data in every worker
+# (including the publishing one).
+class LocalBus:
+    def __init__(self):
+        self._handlers = {}
+
+    def subscribe(self, channel, handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def publish(self, channel, data):
+        self._dispatch(channel, data)
+
+    def _dispatch(self, channel, data):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(data)
+            except Exception:
+                logger.exception("Event bus handler failed for channel %s", channel)
+
+
+# Broker-less bus for several worker processes on one host. Each worker binds
+# a datagram socket in a shared directory; publish delivers locally and sends
+# one datagram to every other socket found there.
+class UnixSocketBus(LocalBus):
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self._process = PerProcess()
+        self._sock = None
+        self._send_sock = None
+        self._path = None
+
+    def start(self):
+        self._process.run(self._start)
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self._sock.bind(self._path)
+        # A worker's datagram queue is short (net.unix.max_dgram_qlen), so
+        # sends wait briefly for it to drain; a worker that is stuck loses
+        # events rather than stalling the request that published them
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_sock.settimeout(SEND_TIMEOUT)
+        threading.Thread(target=self._receive, args=(self._sock,), daemon=True).start()
+        atexit.register(self.close)
+
+    def close(self):
+        if not self._process.started():
+            return
+        self._process.reset()
+        try:
+            self._sock.close()
+            self._send_sock.close()
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def publish(self, channel, data):
+        self.start()
+        self._dispatch(channel, data)
+
+        packet = json.dumps({'channel': channel, 'data': data}).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self._path or not name.endswith('.sock'):
+                continue
+            try:
+                self._send_sock.sendto(packet, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket left behind by a worker that has exited
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logger.warning("Event bus could not deliver to %s: %s", name, e)
+
+    def _receive(self, sock):
+        while True:
+            try:
+                packet = sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                event = json.loads(packet)
+            except ValueError:
+                continue
+            self._dispatch(event['channel'], event['data'])
+
+
+def create_bus(kind, directory=None):
+    if kind == 'local':
+        return LocalBus()
+    if kind == 'unix':
+        return UnixSocketBus(directory)
+    raise ValueError(f"Unknown event bus: {kind}")
@@ -0,0 +1,210 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Rough per-message overhead of the dict on top of its strings, for the byte cap
+_MESSAGE_OVERHEAD = 400
+
+
+def _size(message):
+    return _MESSAGE_OVERHEAD + sum(len(value) for value in message.values() if isinstance(value, str))
+
+
+class _Buffer:
+    def __init__(self, messages, last_change_id, complete):
+        self.messages = list(messages)
+        self.ids = [message['id'] for message in self.messages]
+        self.last_id = self.ids[-1] if self.ids else 0
+        self.last_change_id = last_change_id
+        # True while the buffer holds every message in the room
+        self.complete = complete
+        self.loaded_at = time.monotonic()
+        self.size = sum(_size(message) for message in self.messages)
+
+
+# The latest messages of each room, as get_messages returns them, so the usual
+# "last 50 messages" read needs no SQL.
+#
+# A buffer only ever holds what was read from the database: it is filled on
+# first use and then caught up with fetch_room_updates from its own cursors
+# (last message id, last change id). Those cursors are only moved by such
+# reads, never by published room events, which can arrive out of commit
+# order. Since writes are serialized, a read that sees message n also sees
+# every message before it, so a buffer at last_id n holds all of the room's
+# messages up to n. Reads pass the room version (from the database); a
+# buffer behind it is a miss, and the caller catches it up or reloads it.
+#
+# Buffers are also reloaded after ttl seconds, which picks up fields changed
+# without a message change (a thumbnail whose 'preview' event was lost).
+#
+# Messages are never modified in place: patches replace the dict, so a list
+# handed out by get() can be serialized while the buffer changes.
+class RecentMessages:
+    def __init__(self, reply_preview, per_room=200, max_rooms=64, max_bytes=32 * 1024 * 1024, ttl=60.0):
+        # Preview shown on replies to an edited (text) message
+        self.reply_preview = reply_preview
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._rooms = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.catch_ups = 0
+        self.drops = 0
+
+    # Messages for a get_messages read (latest, before_id or after_id paging),
+    # or None when the buffer is missing, behind version or does not cover the range
+    def get(self, room, version, limit, before_id=None, after_id=None):
+        with self._lock:
+            buf = self._rooms.get(room)
+            messages = None
+            if buf is not None and time.monotonic() - buf.loaded_at > self.ttl:
+                self._drop(room)
+                buf = None
+            if buf is not None and buf.last_id >= version[0] and buf.last_change_id >= version[1]:
+                messages = self._select(buf, limit, before_id, after_id)
+            if messages is None:
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room)
+            self.hits += 1
+            return messages
+
+    def _select(self, buf, limit, before_id, after_id):
+        if after_id is not None:
+            # Every message newer than after_id is here if after_id is inside the buffer
+            if not buf.complete and (not buf.ids or after_id < buf.ids[0]):
+                return None
+            start = bisect_left(buf.ids, after_id + 1)
+            return buf.messages[start:start + limit]
+        end = len(buf.ids) if before_id is None else bisect_left(buf.ids, before_id)
+        if end < limit and not buf.complete:
+            return None
+        return buf.messages[max(0, end - limit):end]
+
+    # (last_id, last_change_id) of a room's buffer, the cursors to catch up from
+    def state(self, room):
+        with self._lock:
+            buf = self._rooms.get(room)
+            return (buf.last_id, buf.last_change_id) if buf else None
+
+    # Installs the latest messages of a room, read from the database (oldest
+    # first, at most per_room). last_change_id must have been read before them.
+    def load(self, room, messages, last_change_id):
+        with self._lock:
+            self._drop(room)
+            buf = _Buffer(messages[-self.per_room:], last_change_id, len(messages) < self.per_room)
+            self._rooms[room] = buf
+            self._bytes += buf.size
+            self.loads += 1
+            self._evict()
+
+    # Applies what fetch_room_updates read from the database after the cursors
+    # in state. False, with nothing applied, if the buffer has moved on since
+    # (another read caught it up first) or the messages do not follow on.
+    def catch_up(self, room, state, messages, changes):
+        with self._lock:
+            buf = self._rooms.get(room)
+            if buf is None or (buf.last_id, buf.last_change_id) != state:
+                return False
+            if messages and messages[0]['id'] <= buf.last_id:
+                self._drop(room)
+                return False
+            for message in messages:
+                self._append(buf, message)
+            for change in changes:
+                self._apply_change(buf, change)
+            if messages:
+                buf.last_id = messages[-1]['id']
+            if changes:
+                buf.last_change_id = changes[-1]['change_id']
+            self.catch_ups += 1
+            self._evict()
+            return True
+
+    # A preview made after the messages using the file were buffered
+    def set_thumbnail(self, file_path, thumbnail_path):
+        with self._lock:
+            for buf in self._rooms.values():
+                for i, message in enumerate(buf.messages):
+                    if message['file_path'] == file_path:
+                        self._replace(buf, i, {**message, 'thumbnail_path': thumbnail_path})
+
+    def _replace(self, buf, i, message):
+        delta = _size(message) - _size(buf.messages[i])
+        buf.messages[i] = message
+        buf.size += delta
+        self._bytes += delta
+
+    def _append(self, buf, message):
+        buf.messages.append(message)
+        buf.ids.append(message['id'])
+        buf.size += _size(message)
+        self._bytes += _size(message)
+        while len(buf.ids) > self.per_room:
+            self._bytes -= _size(buf.messages[0])
+            buf.size -= _size(buf.messages[0])
+            del buf.messages[0], buf.ids[0]
+            buf.complete = False
+
+    # Changes to messages older than the buffer only matter for the reply
+    # previews of buffered messages; changes to messages newer than what was
+    # read are already reflected when those messages are read
+    def _apply_change(self, buf, change):
+        message_id = change['id']
+        i = bisect_left(buf.ids, message_id)
+        if i < len(buf.ids) and buf.ids[i] == message_id:
+            if change['type'] == 'edit':
+                self._replace(buf, i, {**buf.messages[i], 'message': change['message'],
+                                       'is_edited': True, 'edited_at': change['edited_at']})
+            else:
+                removed = buf.messages.pop(i)
+                del buf.ids[i]
+                buf.size -= _size(removed)
+                self._bytes -= _size(removed)
+
+        # Replies show a preview of the message they answer
+        for j in range(i, len(buf.messages)):
+            reply = buf.messages[j]
+            if reply['reply_to'] == message_id and 'reply_username' in reply:
+                if change['type'] == 'edit':
+                    self._replace(buf, j, {**reply, 'reply_preview': self.reply_preview(change['message'])})
+                else:
+                    self._replace(buf, j, {k: v for k, v in reply.items()
+                                           if k not in ('reply_username', 'reply_preview')})
+
+    def _drop(self, room):
+        buf = self._rooms.pop(room, None)
+        if buf is not None:
+            self._bytes -= buf.size
+            self.drops += 1
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._rooms)))
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._rooms),
+                'messages': sum(len(buf.ids) for buf in self._rooms.values()),
+                'bytes': self._bytes,
+                'max_rooms': self.max_rooms,
+                'max_bytes': self.max_bytes,
+                'per_room': self.per_room,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'catch_ups': self.catch_ups,
+                'drops': self.drops,
+            }
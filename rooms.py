@@ -0,0 +1,65 @@
+import json
+import time
+import threading
+from collections import namedtuple
+
+from database import get_db
+
+Room = namedtuple('Room', ['name', 'description', 'allowed_roles', 'is_active'])
+
+
+# Process-wide view of the rooms table with allowed_roles pre-parsed into
+# frozensets, so room access checks on the chat hot path are dict lookups.
+# Reloaded after invalidate() (broadcast to every worker when rooms change)
+# or, as a safety net, once the snapshot is older than ttl seconds.
+class RoomRegistry:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._rooms = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._loaded_generation = -1
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+
+    def _snapshot(self):
+        rooms = self._rooms
+        if (rooms is None or self._loaded_generation != self._generation
+                or time.monotonic() - self._loaded_at > self.ttl):
+            rooms = self._load()
+        return rooms
+
+    def _load(self):
+        with self._lock:
+            generation = self._generation
+        c = get_db().cursor()
+        c.execute("SELECT name, description, allowed_roles, is_active FROM rooms")
+        rooms = {}
+        for name, description, allowed_roles, is_active in c.fetchall():
+            rooms[name] = Room(name, description, frozenset(json.loads(allowed_roles or '[]')), bool(is_active))
+        with self._lock:
+            # An invalidate() that raced with this load wins; the next call reloads
+            self._rooms = rooms
+            self._loaded_at = time.monotonic()
+            self._loaded_generation = generation
+        return rooms
+
+    def get(self, name):
+        return self._snapshot().get(name)
+
+    def can_access(self, role, name):
+        room = self._snapshot().get(name)
+        return room is not None and (role == 'admin' or role in room.allowed_roles)
+
+    # Active rooms the role may enter, in table order
+    def visible_rooms(self, role):
+        return [room for room in self._snapshot().values()
+                if room.is_active and (role == 'admin' or role in room.allowed_roles)]
+
+    # Every room, active or not, whose history the role may read
+    def accessible_names(self, role):
+        return [room.name for room in self._snapshot().values()
+                if role == 'admin' or role in room.allowed_roles]
@@ -16,6 +16,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const searchBox = document.getElementById('search-box');
     const searchInput = document.getElementById('search-input');
     const searchBtn = document.getElementById('search-btn');
+    const searchAllRooms = document.getElementById('search-all-rooms');
     const sendButton = document.getElementById('send-button');
     
     // File upload elements
@@ -47,6 +48,9 @@ document.addEventListener('DOMContentLoaded', function() {
     
     let currentRoom = null;
     let messagePolling = null;
+    let eventSource = null;
+    let lastMessageId = 0;
+    let lastChangeId = null;
     let currentUsername = document.body.dataset.username || "{{ username }}";
     let currentFile = null;
     let currentFileType = null;
@@ -69,11 +73,17 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
+        stopLiveUpdates();
+        lastMessageId = 0;
+        lastChangeId = null;
+        
         fetch(`/get_messages/${room}?limit=50`)
             .then(response => {
                 if (response.status === 403) throw new Error('Access denied to this room');
                 if (response.status === 404) throw new Error('Room not found');
                 if (!response.ok) throw new Error('Network response was not ok');
+                const changeId = response.headers.get('X-Last-Change-Id');
+                if (changeId !== null) lastChangeId = parseInt(changeId, 10);
                 return response.json();
             })
             .then(messages => {
@@ -90,10 +100,12 @@ document.addEventListener('DOMContentLoaded', function() {
                     `;
                 } else {
                     messages.forEach(message => addMessageToChat(message));
+                    advanceCursor(messages);
                     setTimeout(addMediaEventListeners, 100);
                 }
                 
                 chatMessages.scrollTop = chatMessages.scrollHeight;
+                if (room === currentRoom) startLiveUpdates(room);
             })
             .catch(error => {
                 console.error('Error loading messages:', error);
@@ -118,7 +130,13 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     // Function to add a message to the chat
+    // Renders a message once, whatever the source. It does not move
+    // lastMessageId: a message we just sent (or a search result) can be newer
+    // than others not yet fetched, which the next poll would then skip.
     function addMessageToChat(message) {
+        // Our own messages arrive both from send_message and from polling
+        if (chatMessages.querySelector(`[data-message-id="${message.id}"]`)) return;
+        
         const isCurrentUser = message.username === currentUsername || "{{ role }}" === 'admin';
         const messageClass = message.username === currentUsername ? 'message-sent' : 'message-received';
         
@@ -132,11 +150,13 @@ document.addEventListener('DOMContentLoaded', function() {
         if (mediaUrl && !mediaUrl.startsWith('/') && !mediaUrl.startsWith('http') && !mediaUrl.startsWith('blob:')) {
             mediaUrl = '/' + mediaUrl;
         }
+        // Small preview in the list; the full file loads when opened or played
+        const thumbnailUrl = message.thumbnail_path ? '/' + message.thumbnail_path : null;
         
         if (message.message_type === 'image') {
             messageContent = `
                 <div class="media-container">
-                    <img src="${mediaUrl}" alt="Shared image" class="img-fluid" data-media-url="${mediaUrl}" onerror="this.style.display='none'; this.nextElementSibling.style.display='block'">
+                    <img src="${thumbnailUrl || mediaUrl}" alt="Shared image" class="img-fluid" loading="lazy" data-media-url="${mediaUrl}" onerror="this.style.display='none'; this.nextElementSibling.style.display='block'">
                     <button class="media-download-btn" data-media-url="${mediaUrl}" data-media-type="image">
                         <i class="fas fa-download"></i>
                     </button>
@@ -146,7 +166,7 @@ document.addEventListener('DOMContentLoaded', function() {
         } else if (message.message_type === 'video') {
             messageContent = `
                 <div class="media-container">
-                    <video controls class="img-fluid" data-media-url="${mediaUrl}" onerror="this.style.display='none'; this.nextElementSibling.style.display='block'">
+                    <video controls class="img-fluid" preload="${thumbnailUrl ? 'none' : 'metadata'}" ${thumbnailUrl ? `poster="${thumbnailUrl}"` : ''} data-media-url="${mediaUrl}" onerror="this.style.display='none'; this.nextElementSibling.style.display='block'">
                         <source src="${mediaUrl}" type="video/mp4">
                         Your browser does not support the video tag.
                     </video>
@@ -174,7 +194,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 </div>
             `;
         } else if (message.message_type === 'document') {
-            const fileName = mediaUrl.split('/').pop();
+            const fileName = message.file_name || mediaUrl.split('/').pop();
             const fileExtension = fileName.split('.').pop().toLowerCase();
             const iconClass = fileExtension === 'pdf' ? 'fas fa-file-pdf' :
                             (fileExtension === 'txt' ? 'fas fa-file-alt' :
@@ -182,7 +202,7 @@ document.addEventListener('DOMContentLoaded', function() {
             messageContent = `
                 <div class="document-container">
                     <i class="${iconClass} document-icon"></i>
-                    <a href="${mediaUrl}" download class="text-decoration-none">${fileName}</a>
+                    <a href="${mediaUrl}" download="${fileName}" class="text-decoration-none">${fileName}</a>
                     <button class="btn btn-sm btn-outline-primary media-download-btn document-download-btn" data-media-url="${mediaUrl}" data-media-type="document">
                         <i class="fas fa-download me-1"></i> Download
                     </button>
@@ -194,7 +214,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         const editedIndicator = message.is_edited ? 
-            `<small class="text-muted d-block mt-1"><i class="fas fa-edit me-1"></i>Edited at ${formatTime(message.edited_at)}</small>` : '';
+            `<small class="text-muted d-block mt-1 edited-indicator"><i class="fas fa-edit me-1"></i>Edited at ${formatTime(message.edited_at)}</small>` : '';
         
         let replyContent = '';
         if (message.reply_to) {
@@ -415,6 +435,128 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Apply an edit or delete reported by the server to the rendered message
+    function applyMessageChange(change) {
+        const messageElement = chatMessages.querySelector(`[data-message-id="${change.id}"]`);
+        if (!messageElement) return;
+        
+        if (change.type === 'delete') {
+            messageElement.remove();
+            return;
+        }
+        
+        const messageContent = messageElement.querySelector('.message-content');
+        if (!messageContent) return;
+        messageContent.textContent = change.message;
+        
+        let editedIndicator = messageElement.querySelector('.edited-indicator');
+        if (!editedIndicator) {
+            editedIndicator = document.createElement('small');
+            editedIndicator.className = 'text-muted d-block mt-1 edited-indicator';
+            messageContent.after(editedIndicator);
+        }
+        editedIndicator.innerHTML = `<i class="fas fa-edit me-1"></i>Edited at ${formatTime(change.edited_at)}`;
+    }
+    
+    // Only messages from get_messages, get_updates and the stream move the
+    // cursor, since those arrive in order with nothing in between left out
+    function advanceCursor(messages) {
+        messages.forEach(message => {
+            if (message.id > lastMessageId) lastMessageId = message.id;
+        });
+    }
+    
+    function appendNewMessages(messages) {
+        if (messages.length === 0) return;
+        const placeholder = chatMessages.querySelector('.text-center.text-muted');
+        if (placeholder && !chatMessages.querySelector('.message-bubble')) placeholder.remove();
+        messages.forEach(message => addMessageToChat(message));
+        advanceCursor(messages);
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+        addMediaEventListeners();
+    }
+    
+    // Fetch only what changed since the last poll: new messages plus edit/delete tombstones
+    function pollUpdates() {
+        // Wait until loadMessages has established where we are in the room
+        if (!currentRoom || lastChangeId === null) return;
+        const room = currentRoom;
+        const url = `/get_updates/${room}?after_id=${lastMessageId}&change_id=${lastChangeId}`;
+        
+        fetch(url)
+            .then(response => {
+                if (!response.ok) throw new Error('Network response was not ok');
+                return response.json();
+            })
+            .then(data => {
+                if (room !== currentRoom) return;
+                
+                appendNewMessages(data.messages);
+                data.changes.forEach(change => applyMessageChange(change));
+                
+                if (data.last_id > lastMessageId) lastMessageId = data.last_id;
+                lastChangeId = data.last_change_id;
+                if (data.has_more) pollUpdates();
+            })
+            .catch(error => console.error('Error polling for messages:', error));
+    }
+    
+    function startPolling() {
+        if (messagePolling) clearInterval(messagePolling);
+        messagePolling = setInterval(pollUpdates, 3000);
+    }
+    
+    function stopLiveUpdates() {
+        if (eventSource) {
+            eventSource.close();
+            eventSource = null;
+        }
+        if (messagePolling) {
+            clearInterval(messagePolling);
+            messagePolling = null;
+        }
+    }
+    
+    // Use the server push stream when the server offers it (served through
+    // asgi.py), and poll otherwise or when the stream is unavailable
+    function startLiveUpdates(room) {
+        stopLiveUpdates();
+        if (document.body.dataset.liveStream !== 'true' || !window.EventSource) {
+            startPolling();
+            return;
+        }
+        
+        const source = new EventSource(`/stream/${room}?after_id=${lastMessageId}&change_id=${lastChangeId}`);
+        eventSource = source;
+        
+        // Event ids are "<last message id>:<last change id>"; keep them so polling can take over
+        function trackCursor(e) {
+            const [messageId, changeId] = (e.lastEventId || '').split(':').map(Number);
+            if (messageId > lastMessageId) lastMessageId = messageId;
+            if (changeId > lastChangeId) lastChangeId = changeId;
+        }
+        
+        source.addEventListener('message', e => {
+            appendNewMessages([JSON.parse(e.data)]);
+            trackCursor(e);
+        });
+        ['edit', 'delete'].forEach(type => source.addEventListener(type, e => {
+            applyMessageChange(JSON.parse(e.data));
+            trackCursor(e);
+        }));
+        // Deltas sent while the stream was closed are lost, so resync the list on each (re)connect
+        source.addEventListener('open', updateOnlineUsers);
+        source.addEventListener('presence', e => applyPresenceChange(JSON.parse(e.data)));
+        source.addEventListener('resync', () => loadMessages(room));
+        source.onerror = () => {
+            // The browser reconnects on its own unless the server refused the stream
+            if (source.readyState === EventSource.CLOSED && eventSource === source) {
+                eventSource = null;
+                startPolling();
+            }
+        };
+    }
+    
     function cancelEdit(messageId) {
         loadMessages(currentRoom);
     }
@@ -460,40 +602,81 @@ document.addEventListener('DOMContentLoaded', function() {
         return text.length <= maxLength ? text : text.substring(0, maxLength) + '...';
     }
     
+    // Other users online, by username; loaded once, then kept current by
+    // 'presence' deltas on the room stream (or by polling without one)
+    const onlineUsers = new Map();
+    let presenceVersion = null;
+    const HEARTBEAT_INTERVAL = 20000;
+    
+    function renderOnlineUsers() {
+        onlineUsersList.innerHTML = '';
+        onlineCountElement.textContent = onlineUsers.size;
+        userCountElement.textContent = `${onlineUsers.size + 1} users`;
+        
+        const currentUserElement = document.createElement('div');
+        currentUserElement.classList.add('d-flex', 'align-items-center', 'mb-2');
+        currentUserElement.innerHTML = `
+            <span class="online-indicator"></span>
+            You (${document.body.dataset.role || 'user'})
+        `;
+        onlineUsersList.appendChild(currentUserElement);
+        
+        [...onlineUsers].sort(([a], [b]) => a.localeCompare(b)).forEach(([username, role]) => {
+            const userElement = document.createElement('div');
+            userElement.classList.add('d-flex', 'align-items-center', 'mb-2');
+            userElement.innerHTML = `
+                <span class="online-indicator"></span>
+                ${escapeHtml(username)} <span class="badge bg-secondary ms-2">${escapeHtml(role)}</span>
+            `;
+            onlineUsersList.appendChild(userElement);
+        });
+    }
+    
+    // Asks only for what changed since the last version seen; the server
+    // answers 304 when nothing did, or the full list if it cannot tell
     function updateOnlineUsers() {
-        fetch('/get_online_users')
+        const url = presenceVersion ? `/get_online_users?since=${encodeURIComponent(presenceVersion)}` : '/get_online_users';
+        fetch(url)
             .then(response => {
+                if (response.status === 304) return null;
                 if (!response.ok) throw new Error('Network response was not ok');
                 return response.json();
             })
-            .then(users => {
-                onlineUsersList.innerHTML = '';
-                onlineCountElement.textContent = users.length;
-                
-                const otherUsers = users.filter(user => user.username !== currentUsername);
-                userCountElement.textContent = `${otherUsers.length + 1} users`;
-                
-                const currentUserElement = document.createElement('div');
-                currentUserElement.classList.add('d-flex', 'align-items-center', 'mb-2');
-                currentUserElement.innerHTML = `
-                    <span class="online-indicator"></span>
-                    You (${document.body.dataset.role || 'user'})
-                `;
-                onlineUsersList.appendChild(currentUserElement);
-                
-                otherUsers.forEach(user => {
-                    const userElement = document.createElement('div');
-                    userElement.classList.add('d-flex', 'align-items-center', 'mb-2');
-                    userElement.innerHTML = `
-                        <span class="online-indicator"></span>
-                        ${escapeHtml(user.username)} <span class="badge bg-secondary ms-2">${user.role}</span>
-                    `;
-                    onlineUsersList.appendChild(userElement);
-                });
+            .then(data => {
+                if (!data) return;
+                if (data.users) {
+                    onlineUsers.clear();
+                    data.users.forEach(user => onlineUsers.set(user.username, user.role));
+                } else {
+                    data.joins.forEach(user => onlineUsers.set(user.username, user.role));
+                    data.leaves.forEach(username => onlineUsers.delete(username));
+                }
+                onlineUsers.delete(currentUsername);
+                presenceVersion = data.version;
+                renderOnlineUsers();
             })
             .catch(error => console.error('Error fetching online users:', error));
     }
     
+    // Only changes to the global list are shown; room joins and leaves arrive too
+    function applyPresenceChange(change) {
+        if (change.room !== null || change.username === currentUsername) return;
+        if (change.op === 'join') {
+            onlineUsers.set(change.username, change.role);
+        } else {
+            onlineUsers.delete(change.username);
+        }
+        renderOnlineUsers();
+    }
+    
+    function sendHeartbeat() {
+        fetch('/heartbeat', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ room: currentRoom })
+        }).catch(error => console.error('Error sending heartbeat:', error));
+    }
+    
     // Handle room selection
     function selectRoom(link) {
         console.log('Room clicked:', link.dataset.room);
@@ -513,30 +696,9 @@ document.addEventListener('DOMContentLoaded', function() {
         if (audioUpload) audioUpload.disabled = false;
         if (documentUpload) documentUpload.disabled = false;
         
+        stopLiveUpdates();
         loadMessages(currentRoom);
-        
-        if (messagePolling) clearInterval(messagePolling);
-        messagePolling = setInterval(() => {
-            if (!currentRoom) return;
-            fetch(`/get_messages/${currentRoom}?limit=1`)
-                .then(response => response.json())
-                .then(messages => {
-                    if (messages.length > 0) {
-                        const lastMessage = messages[messages.length - 1];
-                        const existingMessages = chatMessages.querySelectorAll('.message-bubble');
-                        const lastDisplayed = existingMessages[existingMessages.length - 1];
-                        
-                        if (!lastDisplayed || 
-                            !lastDisplayed.querySelector('.message-time').textContent.includes(
-                                formatTime(lastMessage.timestamp))) {
-                            addMessageToChat(lastMessage);
-                            chatMessages.scrollTop = chatMessages.scrollHeight;
-                            addMediaEventListeners();
-                        }
-                    }
-                })
-                .catch(error => console.error('Error polling for messages:', error));
-        }, 3000);
+        sendHeartbeat();
     }
     
     // Attach room selection listeners
@@ -548,6 +710,47 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
+    // Sends a file to /uploads in pieces, resuming from the server's offset
+    // after a failed piece
+    const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+    const UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024;
+    const UPLOAD_RETRIES = 5;
+    
+    function uploadResumable(file) {
+        const params = new URLSearchParams({ filename: file.name, size: file.size });
+        return fetch('/uploads', { method: 'POST', body: params })
+            .then(response => response.json().then(data => {
+                if (!response.ok) throw new Error(data.error || 'Upload failed');
+                return data.upload_id;
+            }))
+            .then(uploadId => {
+                let retries = 0;
+                
+                function sendFrom(offset) {
+                    if (offset >= file.size) return uploadId;
+                    const piece = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+                    return fetch(`/uploads/${uploadId}?offset=${offset}`, { method: 'PUT', body: piece })
+                        .then(response => response.json().then(data => {
+                            if (!response.ok && response.status !== 409) throw new Error(data.error || 'Upload failed');
+                            return response.ok ? data.offset : null;
+                        }))
+                        .catch(error => {
+                            if (++retries > UPLOAD_RETRIES) throw error;
+                            return null;
+                        })
+                        .then(next => {
+                            if (next !== null) return sendFrom(next);
+                            // Ask the server how much it has before resending
+                            return fetch(`/uploads/${uploadId}`)
+                                .then(response => response.json())
+                                .then(status => sendFrom(status.offset));
+                        });
+                }
+                
+                return sendFrom(0);
+            });
+    }
+    
     // Handle message submission
     messageForm.addEventListener('submit', function(e) {
         e.preventDefault();
@@ -565,8 +768,10 @@ document.addEventListener('DOMContentLoaded', function() {
         formData.append('room', currentRoom);
         formData.append('message_type', currentFileType || 'text');
         
+        // Large files go up in resumable pieces first; the message then refers to the upload
+        const chunked = currentFile && currentFile.size > CHUNKED_UPLOAD_THRESHOLD;
         if (currentFile) {
-            formData.append('file', currentFile);
+            if (!chunked) formData.append('file', currentFile);
             if (messageInput.value.trim()) formData.append('message', messageInput.value.trim());
         } else {
             formData.append('message', messageInput.value.trim());
@@ -578,10 +783,15 @@ document.addEventListener('DOMContentLoaded', function() {
             cancelReply();
         }
         
-        fetch('/send_message', {
+        const uploaded = chunked
+            ? uploadResumable(currentFile).then(uploadId => formData.append('upload_id', uploadId))
+            : Promise.resolve();
+        
+        uploaded
+        .then(() => fetch('/send_message', {
             method: 'POST',
             body: formData
-        })
+        }))
         .then(response => {
             if (!response.ok) {
                 return response.json().then(err => { throw new Error(err.error || 'Network response was not ok'); });
@@ -771,11 +981,18 @@ function clearFileSelection() {
     if (searchBtn && searchInput) {
         searchBtn.addEventListener('click', function() {
             const query = searchInput.value.trim();
-            if (query === '' || !currentRoom) return;
+            const allRooms = searchAllRooms && searchAllRooms.checked;
+            if (query === '' || (!currentRoom && !allRooms)) return;
+            
+            const url = allRooms
+                ? `/search_messages?q=${encodeURIComponent(query)}&scope=all`
+                : `/search_messages?q=${encodeURIComponent(query)}&room=${currentRoom}`;
             
-            fetch(`/search_messages?q=${encodeURIComponent(query)}&room=${currentRoom}`)
+            fetch(url)
                 .then(response => response.json())
-                .then(results => {
+                .then(data => {
+                    // Cross-room searches return {results, room_counts, next_cursor}
+                    const results = allRooms ? data.results : data;
                     chatMessages.innerHTML = '';
                     if (results.length === 0) {
                         chatMessages.innerHTML = `
@@ -785,7 +1002,23 @@ function clearFileSelection() {
                             </div>
                         `;
                     } else {
-                        results.forEach(message => addMessageToChat(message));
+                        if (allRooms && data.room_counts) {
+                            const summary = document.createElement('div');
+                            summary.className = 'text-center text-muted small mb-3';
+                            summary.textContent = Object.entries(data.room_counts)
+                                .map(([room, count]) => `#${room}: ${count}`)
+                                .join('  ·  ');
+                            chatMessages.appendChild(summary);
+                        }
+                        results.forEach(message => {
+                            if (allRooms) {
+                                const label = document.createElement('div');
+                                label.className = 'small text-primary mb-1';
+                                label.textContent = `#${message.room}`;
+                                chatMessages.appendChild(label);
+                            }
+                            addMessageToChat(message);
+                        });
                         addMediaEventListeners();
                     }
                 })
@@ -800,7 +1033,12 @@ function clearFileSelection() {
         });
     }
     
-    // Initial update of online users
+    // Initial update of online users; afterwards the list is polled only
+    // while no stream is delivering presence changes
+    sendHeartbeat();
     updateOnlineUsers();
-    setInterval(updateOnlineUsers, 10000);
+    setInterval(sendHeartbeat, HEARTBEAT_INTERVAL);
+    setInterval(() => {
+        if (!eventSource) updateOnlineUsers();
+    }, 10000);
 });
\ No newline at end of file
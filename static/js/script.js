@@ -556,7 +556,7 @@ function submitMessageForm(formData) {
                 }
                 return response.json();
             })
-            .then(users => {
+            .then(({ users }) => {
                 onlineUsersList.innerHTML = '';
                 onlineCountElement.textContent = users.length;
                 
@@ -0,0 +1,54 @@
+import os
+import json
+import uuid
+import tempfile
+
+import pytest
+
+# kgoloko_app creates its database and upload folders in the working
+# directory on import
+os.chdir(tempfile.mkdtemp())
+import kgoloko_app  # noqa: E402
+
+app = kgoloko_app.app
+app.config['JOB_QUEUE_INLINE'] = True
+
+
+def add_user(username, role='student'):
+    with app.app_context():
+        conn = kgoloko_app.get_db()
+        conn.execute("INSERT OR IGNORE INTO users (username, password, role, approved) VALUES (?, 'x', ?, TRUE)",
+                     (username, role))
+        user_id = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+        conn.commit()
+    return user_id
+
+
+def log_in(username='tester', role='student'):
+    user_id = add_user(username, role)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update(username=username, role=role, user_id=user_id, unique_id=user_id)
+    return client
+
+
+@pytest.fixture
+def client():
+    return log_in()
+
+
+def add_room(roles=('student', 'teacher')):
+    name = f"room-{uuid.uuid4().hex[:8]}"
+    with app.app_context():
+        conn = kgoloko_app.get_db()
+        conn.execute("INSERT INTO rooms (name, description, allowed_roles, created_by) VALUES (?, '', ?, 'tests')",
+                     (name, json.dumps(list(roles))))
+        conn.commit()
+    kgoloko_app.room_registry.invalidate()
+    return name
+
+
+# A new room open to students, so every test starts from an empty history
+@pytest.fixture
+def room():
+    return add_room()
@@ -0,0 +1,48 @@
+import kgoloko_app
+from conftest import app, add_room
+
+
+def stored(ids):
+    with app.app_context():
+        rows = kgoloko_app.get_db().execute(
+            f"SELECT id, room, message, reply_to FROM messages WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        return {row[0]: row[1:] for row in rows}
+
+
+def test_batch_ids_match_the_rows_written(client, room):
+    other = add_room()
+    client.post('/send_message', data={'room': room, 'message': 'before', 'message_type': 'text'})
+    items = [{'room': room if i % 2 else other, 'message': f'batch {i}'} for i in range(6)]
+    response = client.post('/send_messages', json={'messages': items}).get_json()
+    client.post('/send_message', data={'room': room, 'message': 'after', 'message_type': 'text'})
+
+    ids = response['ids']
+    assert ids == sorted(ids) and len(set(ids)) == len(items)
+    rows = stored(ids)
+    assert [rows[i][:2] for i in ids] == [(item['room'], item['message']) for item in items]
+
+
+def test_batch_replies_only_count_within_their_room(client, room):
+    other = add_room()
+    target = client.post('/send_message', data={'room': room, 'message': 'question',
+                                                'message_type': 'text'}).get_json()['id']
+    response = client.post('/send_messages', json={'messages': [
+        {'room': room, 'message': 'answer', 'reply_to': target},
+        {'room': other, 'message': 'wrong room', 'reply_to': target},
+    ]}).get_json()
+    rows = stored(response['ids'])
+    assert [rows[i][2] for i in response['ids']] == [target, None]
+
+    answer = client.get(f'/get_messages/{room}').get_json()[-1]
+    assert answer['reply_username'] == 'tester' and answer['reply_preview'] == 'question'
+
+
+def test_invalid_batch_writes_nothing(client, room):
+    before = client.get(f'/get_messages/{room}').get_json()
+    response = client.post('/send_messages', json={'messages': [
+        {'room': room, 'message': 'fine'},
+        {'room': room, 'message': '   '},
+    ]})
+    assert response.status_code == 400
+    assert response.get_json()['errors'][0]['index'] == 1
+    assert client.get(f'/get_messages/{room}').get_json() == before
@@ -0,0 +1,37 @@
+import pytest
+
+import kgoloko_app
+from conftest import app
+from database import get_pool
+
+job_queue = kgoloko_app.job_queue
+runs = []
+
+
+@job_queue.task('test_record')
+def record(value):
+    runs.append(value)
+
+
+def test_enqueue_reuses_the_request_connection():
+    with app.app_context():
+        kgoloko_app.get_db()
+        checkouts = get_pool(app).stats()['checkouts']
+        job_queue.enqueue('test_record', value='reused')
+        assert get_pool(app).stats()['checkouts'] == checkouts
+    assert runs[-1] == 'reused'
+
+
+def test_enqueue_refuses_an_open_transaction():
+    with app.app_context():
+        conn = kgoloko_app.get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        with pytest.raises(RuntimeError):
+            job_queue.enqueue('test_record', value='never')
+        conn.rollback()
+    assert 'never' not in runs
+
+
+def test_enqueue_outside_a_request():
+    job_queue.enqueue('test_record', value='standalone')
+    assert runs[-1] == 'standalone'
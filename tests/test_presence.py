@@ -0,0 +1,58 @@
+from conftest import log_in
+from presence import PresenceTracker
+
+
+def test_changes_since_nets_out_what_the_client_never_saw():
+    tracker = PresenceTracker(ttl=30)
+    tracker.beat(1, 'amy', 'student', now=0)
+    token = tracker.version()
+
+    tracker.beat(2, 'ben', 'student', now=1)
+    tracker.beat(3, 'cat', 'teacher', now=1)
+    tracker.leave(3)
+    tracker.leave(1)
+    _, joins, leaves = tracker.changes_since(token)
+    assert joins == [{'username': 'ben', 'role': 'student'}]
+    assert leaves == ['amy']
+
+    latest, joins, leaves = tracker.changes_since(tracker.version())
+    assert (joins, leaves) == ([], [])
+    assert latest == tracker.version()
+
+
+def test_room_deltas_and_expiry():
+    tracker = PresenceTracker(ttl=30)
+    token = tracker.version()
+    tracker.beat(1, 'amy', 'student', room='maths', now=0)
+    _, joins, _ = tracker.changes_since(token, room='maths')
+    assert joins == [{'username': 'amy', 'role': 'student'}]
+
+    token = tracker.version()
+    tracker.expire(now=31)
+    assert tracker.changes_since(token, room='maths')[2] == ['amy']
+    assert tracker.changes_since(token)[2] == ['amy']
+    assert tracker.online() == []
+
+
+def test_unanswerable_tokens_get_none():
+    tracker = PresenceTracker(ttl=30, log_size=2)
+    old = tracker.version()
+    for user_id in range(3):
+        tracker.beat(user_id, f'user{user_id}', 'student', now=0)
+    assert tracker.changes_since(old) is None
+    assert tracker.changes_since(PresenceTracker().version()) is None
+    assert tracker.changes_since('garbage') is None
+
+
+def test_get_online_users_sends_deltas_then_304(room):
+    watcher = log_in('watcher')
+    snapshot = watcher.get(f'/get_online_users?room={room}').get_json()
+    assert 'users' in snapshot
+
+    newcomer = log_in('newcomer')
+    newcomer.post('/heartbeat', json={'room': room})
+    delta = watcher.get(f"/get_online_users?room={room}&since={snapshot['version']}").get_json()
+    assert delta['joins'] == [{'username': 'newcomer', 'role': 'student'}]
+    assert delta['leaves'] == []
+
+    assert watcher.get(f"/get_online_users?room={room}&since={delta['version']}").status_code == 304
@@ -0,0 +1,65 @@
+import kgoloko_app
+from conftest import app
+
+
+# Commits a message the way send_message does, without publishing its event
+def commit_message(room, text):
+    with app.app_context():
+        conn = kgoloko_app.get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        message_id = conn.execute("INSERT INTO messages (room, username, message) VALUES (?, 'tester', ?)",
+                                  (room, text)).lastrowid
+        conn.commit()
+    return message_id
+
+
+def publish(room, message_id, text):
+    kgoloko_app.publish_room_event(room, 'message', {'id': message_id, 'room': room, 'message': text})
+
+
+def message_ids(response):
+    return [message['id'] for message in response.get_json()]
+
+
+def test_out_of_order_publishes_never_drop_a_message(client, room):
+    for i in range(3):
+        publish(room, commit_message(room, f'before {i}'), f'before {i}')
+    client.get(f'/get_messages/{room}?limit=50')  # fills the buffer
+
+    first = commit_message(room, 'A')
+    second = commit_message(room, 'B')
+    publish(room, second, 'B')  # B's event overtakes A's
+    response = client.get(f'/get_messages/{room}?limit=50')
+    assert message_ids(response)[-2:] == [first, second]
+
+    # Once A's event arrives the list the client holds is still the current one
+    publish(room, first, 'A')
+    revalidated = client.get(f'/get_messages/{room}?limit=50', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+
+
+def test_etag_changes_when_a_late_message_is_committed(client, room):
+    response = client.get(f'/get_messages/{room}?limit=50')
+    late = commit_message(room, 'late')
+    publish(room, late, 'late')
+    revalidated = client.get(f'/get_messages/{room}?limit=50', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 200
+    assert message_ids(revalidated) == [late]
+
+
+def test_events_alone_do_not_add_messages(client, room):
+    commit_message(room, 'kept')
+    before = message_ids(client.get(f'/get_messages/{room}?limit=50'))
+    publish(room, before[-1] + 1000, 'never committed')
+    assert message_ids(client.get(f'/get_messages/{room}?limit=50')) == before
+
+
+def test_buffer_catches_up_with_edits_and_deletes(client, room):
+    ids = [commit_message(room, f'm{i}') for i in range(3)]
+    client.get(f'/get_messages/{room}?limit=50')
+
+    client.post('/edit_message', json={'message_id': ids[0], 'new_message': 'edited'})
+    client.post('/delete_message', json={'message_id': ids[1]})
+    messages = client.get(f'/get_messages/{room}?limit=50').get_json()
+    assert [m['id'] for m in messages] == [ids[0], ids[2]]
+    assert messages[0]['message'] == 'edited' and messages[0]['is_edited']
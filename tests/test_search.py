@@ -0,0 +1,54 @@
+import pytest
+
+import kgoloko_app
+from conftest import add_room
+
+pytestmark = pytest.mark.skipif(not kgoloko_app.fts_enabled, reason="SQLite built without FTS5")
+
+
+def send(client, room, text):
+    client.post('/send_message', data={'room': room, 'message': text, 'message_type': 'text'})
+
+
+def page_through(client, url, limit):
+    ids, cursor = [], None
+    while True:
+        response = client.get(url + f'&limit={limit}' + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        ids += [result['id'] for result in response.get_json()]
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return ids
+
+
+@pytest.mark.parametrize('sort', ['rank', 'recent'])
+def test_keyset_pages_cover_every_result_once(client, room, sort):
+    # Repeated texts give equal ranks, so ties are broken by id across pages
+    for i in range(14):
+        send(client, room, 'homework ' * (i % 3 + 1) + f'note {i}')
+    send(client, room, 'nothing to see')
+
+    url = f'/search_messages?q=homework&room={room}&sort={sort}'
+    everything = [result['id'] for result in client.get(url + '&limit=200').get_json()]
+    assert len(everything) == 14
+    assert page_through(client, url, 4) == everything
+    if sort == 'recent':
+        assert everything == sorted(everything, reverse=True)
+
+
+def test_cross_room_pages_only_count_on_the_first(client, room):
+    other = add_room()
+    for i in range(5):
+        send(client, room if i % 2 else other, f'exam {i}')
+
+    first = client.get('/search_messages?q=exam&scope=all&limit=3').get_json()
+    assert sum(first['room_counts'].get(name, 0) for name in (room, other)) == 5
+    second = client.get(f"/search_messages?q=exam&scope=all&limit=3&cursor={first['next_cursor']}").get_json()
+    assert second['room_counts'] is None
+    ids = [r['id'] for r in first['results'] + second['results'] if r['room'] in (room, other)]
+    assert len(ids) == len(set(ids)) == 5
+
+
+def test_malformed_cursor_is_rejected(client, room):
+    assert client.get(f'/search_messages?q=exam&room={room}&cursor=nonsense').status_code == 400
+    assert client.get(f'/search_messages?q=exam&room={room}&sort=recent&cursor=x').status_code == 400
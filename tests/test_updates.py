@@ -0,0 +1,43 @@
+import kgoloko_app
+from conftest import app
+
+
+def send(client, room, text):
+    return client.post('/send_message', data={'room': room, 'message': text, 'message_type': 'text'}).get_json()['id']
+
+
+def test_get_messages_clamps_limit(client, room):
+    ids = [send(client, room, f'm{i}') for i in range(3)]
+    for limit in (0, -1):
+        messages = client.get(f'/get_messages/{room}?limit={limit}').get_json()
+        assert [m['id'] for m in messages] == ids[-1:]
+    assert client.get(f'/get_messages/{room}?limit={10 ** 30}').status_code == 200
+
+
+def test_get_updates_clamps_limit(client, room):
+    first = send(client, room, 'first')
+    second = send(client, room, 'second')
+    data = client.get(f'/get_updates/{room}?after_id=0&change_id=0&limit=0').get_json()
+    assert [m['id'] for m in data['messages']] == [first]
+    assert data['has_more']
+    data = client.get(f'/get_updates/{room}?after_id={first}&change_id=0&limit=-1').get_json()
+    assert [m['id'] for m in data['messages']] == [second]
+    assert client.get(f'/get_updates/{room}?after_id=0&limit={10 ** 30}').status_code == 200
+
+
+def test_get_updates_pages_through_changes(client, room):
+    message_id = send(client, room, 'draft')
+    for i in range(5):
+        client.post('/edit_message', json={'message_id': message_id, 'new_message': f'edit {i}'})
+
+    after_id = message_id
+    change_id, seen = 0, []
+    while True:
+        data = client.get(f'/get_updates/{room}?after_id={after_id}&change_id={change_id}&limit=2').get_json()
+        assert len(data['changes']) <= 2
+        seen += [change['message'] for change in data['changes']]
+        change_id = data['last_change_id']
+        if not data['has_more']:
+            break
+    assert seen == [f'edit {i}' for i in range(5)]
+
@@ -0,0 +1,105 @@
+import io
+import os
+
+import pytest
+
+import kgoloko_app
+from conftest import app
+
+
+def image_bytes(color='red'):
+    # Previews need Pillow, which the app treats as optional
+    Image = pytest.importorskip('PIL.Image')
+    data = io.BytesIO()
+    Image.new('RGB', (640, 480), color).save(data, 'JPEG')
+    return data.getvalue()
+
+
+def send_file(client, room, content, filename, message_type='image', **form):
+    response = client.post('/send_message', data={
+        'room': room, 'message': '', 'message_type': message_type, 'file': (io.BytesIO(content), filename), **form,
+    }, content_type='multipart/form-data')
+    return response.get_json()
+
+
+def on_disk(url_path):
+    return os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], url_path.split('/')[-1]))
+
+
+def ref_count(file_path):
+    with app.app_context():
+        row = kgoloko_app.get_db().execute("SELECT ref_count FROM uploads WHERE file_path = ?",
+                                           (file_path,)).fetchone()
+    return row[0] if row else None
+
+
+def leftover_temp_files():
+    return [name for name in os.listdir(app.config['UPLOAD_TMP_FOLDER']) if name.endswith('.part')]
+
+
+def test_same_content_is_stored_once_and_counted(client, room):
+    first = send_file(client, room, b'shared notes', 'notes.txt', 'document')
+    second = send_file(client, room, b'shared notes', 'copy.txt', 'document')
+    assert first['file_path'] == second['file_path']
+    assert ref_count(first['file_path']) == 2
+    assert not leftover_temp_files()
+
+    client.post('/delete_message', json={'message_id': first['id']})
+    assert ref_count(first['file_path']) == 1
+    assert on_disk(first['file_path'])
+
+    client.post('/delete_message', json={'message_id': second['id']})
+    assert ref_count(first['file_path']) is None
+    assert not on_disk(first['file_path'])
+
+
+def test_resending_deleted_content_puts_the_file_back(client, room):
+    first = send_file(client, room, b'sent twice', 'a.txt', 'document')
+    client.post('/delete_message', json={'message_id': first['id']})
+    assert not on_disk(first['file_path'])
+
+    second = send_file(client, room, b'sent twice', 'a.txt', 'document')
+    assert second['file_path'] == first['file_path']
+    assert on_disk(second['file_path'])
+    assert ref_count(second['file_path']) == 1
+
+
+def test_failed_insert_leaves_no_file(client, room, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('insert failed')
+    monkeypatch.setattr(kgoloko_app, 'insert_message', fail)
+    response = send_file(client, room, b'never referenced', 'lost.txt', 'document')
+    assert response['status'] == 'error'
+    assert not any(name.startswith(kgoloko_app.hashlib.sha256(b'never referenced').hexdigest())
+                   for name in os.listdir(app.config['UPLOAD_FOLDER']))
+    assert not leftover_temp_files()
+
+
+def test_resumable_upload_is_stored_by_content(client, room):
+    upload = client.post('/uploads', data={'filename': 'big.txt', 'size': 10}).get_json()
+    client.put(f"/uploads/{upload['upload_id']}?offset=0", data=b'01234')
+    client.put(f"/uploads/{upload['upload_id']}?offset=5", data=b'56789')
+    message = client.post('/send_message', data={'room': room, 'message': '', 'message_type': 'document',
+                                                  'upload_id': upload['upload_id']}).get_json()
+    assert message['file_path'].endswith(kgoloko_app.hashlib.sha256(b'0123456789').hexdigest() + '.txt')
+    assert on_disk(message['file_path'])
+    assert ref_count(message['file_path']) == 1
+
+
+def test_preview_is_kept_while_any_copy_of_the_content_is(client, room):
+    content = image_bytes('green')
+    jpg = send_file(client, room, content, 'photo.jpg')
+    jpeg = send_file(client, room, content, 'photo.jpeg')
+    assert jpg['file_path'] != jpeg['file_path']
+
+    messages = {m['id']: m for m in client.get(f'/get_messages/{room}').get_json()}
+    thumbnail = messages[jpeg['id']]['thumbnail_path']
+    assert thumbnail and thumbnail == messages[jpg['id']]['thumbnail_path']
+
+    client.post('/delete_message', json={'message_id': jpg['id']})
+    assert not on_disk(jpg['file_path'])
+    assert on_disk(thumbnail)
+
+    client.post('/delete_message', json={'message_id': jpeg['id']})
+    assert not on_disk(jpeg['file_path'])
+    assert not on_disk(thumbnail)
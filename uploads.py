@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+from collections import namedtuple
+
+from flask import Request, current_app
+
+CHUNK_SIZE = 64 * 1024
+
+# An upload headed for the content-addressed store: path is its name there,
+# temp_path the hashed temporary file that install_blob moves into place (or
+# that discard_temp removes when the same content is already stored).
+Blob = namedtuple('Blob', ['path', 'sha256', 'size', 'temp_path'])
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+_BLOB_NAME = re.compile(r'^([0-9a-f]{64}(?:\.thumb)?)(\.[A-Za-z0-9]+)?$')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# Temporary file that hashes everything written to it, so an upload's digest
+# and size are known as soon as the request body has been parsed. Unless it
+# has been moved into place with store(), the file is removed on close.
+class HashingFile:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.stored = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._file.close()
+        if not self.stored:
+            try:
+                os.unlink(self.name)
+            except OSError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+# Werkzeug writes each uploaded file part to the stream returned here as it
+# parses the body, in small chunks, instead of a SpooledTemporaryFile that
+# keeps uploads under 500KB in memory and cannot report a hash.
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(current_app.config['UPLOAD_TMP_FOLDER'])
+
+
+def copy_to_temp(stream, directory):
+    temp = HashingFile(directory)
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            temp.write(chunk)
+    except Exception:
+        temp.close()
+        raise
+    return temp
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The content hash a stored file (or its preview) is named after, or None for
+# files saved before the content-addressed store
+def blob_hash(name):
+    match = _BLOB_NAME.match(name)
+    return match.group(1) if match else None
+
+
+def blob_path(directory, sha256, ext):
+    return os.path.join(directory, f"{sha256}.{ext}" if ext else sha256)
+
+
+def make_blob(temp_path, sha256, size, directory, ext):
+    return Blob(blob_path(directory, sha256, ext), sha256, size, temp_path)
+
+
+# Moves the temporary file to its content-addressed name with an atomic
+# rename (the temporary directory must be on the same filesystem), unless
+# that content is already stored. Must run inside the write transaction that
+# records the reference to it: remove_upload deletes files under the same
+# lock, so it can never remove one placed here before the reference commits.
+def install_blob(blob):
+    if not os.path.exists(blob.path):
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        os.replace(blob.temp_path, blob.path)
+
+
+# The uploaded file, hashed; the returned blob owns the temporary file from
+# here on (see install_blob and discard_temp)
+def store(file_storage, directory, ext):
+    temp = file_storage.stream
+    if not isinstance(temp, HashingFile):
+        temp = copy_to_temp(temp, current_app.config['UPLOAD_TMP_FOLDER'])
+        file_storage.stream = temp
+    temp.flush()
+    temp.stored = True
+    return make_blob(temp.name, temp.hexdigest(), temp.size, directory, ext)
+
+
+# Called once the message referencing blob has been committed (or has
+# failed); the file is only still there if the content was already stored
+def discard_temp(blob):
+    if blob is not None and blob.temp_path:
+        try:
+            os.unlink(blob.temp_path)
+        except OSError:
+            pass
+
+
+# Resumable uploads for files too large to send in one request. The client
+# creates an upload, PUTs the file in pieces at increasing offsets (asking
+# for the current offset to resume after a dropped connection), then sends
+# the message with the upload id. State lives next to the partial file so any
+# worker can serve any piece.
+class ResumableUploads:
+    def __init__(self, directory, max_size, ttl=24 * 3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _paths(self, upload_id):
+        if not upload_id or not _UPLOAD_ID.match(upload_id):
+            raise UploadError('Upload not found', 404)
+        base = os.path.join(self.directory, upload_id)
+        return base + '.upload', base + '.json'
+
+    def _load(self, upload_id, user_id):
+        data_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError('Upload not found', 404)
+        if meta['user_id'] != user_id:
+            raise UploadError('Upload not found', 404)
+        meta['offset'] = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        return meta
+
+    def create(self, user_id, filename, size):
+        if size <= 0 or size > self.max_size:
+            raise UploadError(f'File size must be between 1 byte and {self.max_size} bytes')
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_stale()
+        upload_id = uuid.uuid4().hex
+        data_path, meta_path = self._paths(upload_id)
+        open(data_path, 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump({'user_id': user_id, 'filename': filename, 'size': size}, f)
+        return upload_id
+
+    def status(self, upload_id, user_id):
+        meta = self._load(upload_id, user_id)
+        return {'upload_id': upload_id, 'offset': meta['offset'], 'size': meta['size']}
+
+    # Appends the request body at offset, which must match what has been received so far
+    def append(self, upload_id, user_id, offset, stream):
+        meta = self._load(upload_id, user_id)
+        if offset != meta['offset']:
+            raise UploadError(f"Expected offset {meta['offset']}", 409)
+        data_path, meta_path = self._paths(upload_id)
+        os.utime(meta_path)
+        received = meta['offset']
+        with open(data_path, 'ab') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if received > meta['size']:
+                    f.truncate(meta['offset'])
+                    raise UploadError('Upload exceeds its declared size', 413)
+                f.write(chunk)
+        return {'upload_id': upload_id, 'offset': received, 'size': meta['size']}
+
+    def filename(self, upload_id, user_id):
+        return self._load(upload_id, user_id)['filename']
+
+    # Hashes a completed upload; the data file becomes the blob's temporary file
+    def finish(self, upload_id, user_id, directory, ext):
+        meta = self._load(upload_id, user_id)
+        if meta['offset'] != meta['size']:
+            raise UploadError(f"Upload incomplete: {meta['offset']} of {meta['size']} bytes received", 409)
+        data_path, meta_path = self._paths(upload_id)
+        blob = make_blob(data_path, hash_file(data_path), meta['size'], directory, ext)
+        os.unlink(meta_path)
+        return blob
+
+    def discard(self, upload_id, user_id):
+        self._load(upload_id, user_id)
+        for path in self._paths(upload_id):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    # Partial uploads nobody has touched within ttl
+    def remove_stale(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass